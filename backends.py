@@ -1,29 +1,478 @@
 #!/usr/bin/env python
-from markov import Token
+import os
+import json
+import math
+import mmap
+import time
+import random
+import heapq
+import struct
+import hashlib
+import cPickle
+import threading
+import traceback
+from collections import OrderedDict
+from array import array
+from bisect import bisect_left
+from itertools import izip, islice
+
+import metrics
+from markov import Token, BeginToken, EndToken
+
+def _hash_toks(toks):
+    """[str] -> hashedtoken()"""
+    return ' '.join(tok.encode('utf-8') for tok in toks)
+
+def _unhash_toks(hkey):
+    """hashedtoken() -> tuple(str)"""
+    return tuple(hkey.split(' '))
+
+def _chunks(seq, size):
+    """Split the list `seq' into lists of at most `size' items"""
+    return [seq[i:i+size] for i in range(0, len(seq), size)]
+
+def _ichunks(it, size):
+    """Lazily split the iterable `it' into lists of at most `size'
+       items"""
+    it = iter(it)
+    return iter(lambda: list(islice(it, size)), [])
+
+def _utf8(tok):
+    return tok.encode('utf-8') if isinstance(tok, unicode) else tok
+
+def _varint(n):
+    """int -> LEB128 str"""
+    out = []
+    while n >= 0x80:
+        out.append(chr((n & 0x7f) | 0x80))
+        n >>= 7
+    out.append(chr(n))
+    return ''.join(out)
+
+def _read_varint(s, i):
+    """Decode the varint at s[i:] -> (int, index after it)"""
+    n = shift = 0
+    while True:
+        b = ord(s[i])
+        i += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, i
+        shift += 7
+
+class StringKeys(object):
+    # The original key encoding: chains are keyed by their
+    # hashedtoken() and followers by their strings
+    def key(self, toks):
+        """[str] -> row key"""
+        return _hash_toks(toks)
+
+    def unkey(self, key):
+        """row key -> tuple(str)"""
+        return _unhash_toks(key)
+
+    def column(self, tok):
+        """str -> column name"""
+        return tok
+
+    def uncolumn(self, column):
+        """column name -> str"""
+        return column
+
+    def owns(self, key):
+        """Whether a row key is in this encoding"""
+        return not key.startswith('\x00')
+
+class CompactKeys(object):
+    # Tokens in the vocabulary (a list of str, most frequent first)
+    # are written as the varint of their position + 1, and tokens that
+    # aren't as a 0 varint, the varint of their length and their
+    # UTF-8. Row keys are a \x00 (which can't start a string key)
+    # followed by the tokens of the chain, and columns are the single
+    # follower token. The vocabulary can't change once anything has
+    # been written with it
+    def __init__(self, vocabulary):
+        self.vocabulary = [_utf8(tok) for tok in vocabulary]
+        self.ids = dict((tok, i+1) for (i, tok) in enumerate(self.vocabulary))
+
+    def _encode(self, tok):
+        tok = _utf8(tok)
+        try:
+            return _varint(self.ids[tok])
+        except KeyError:
+            return '\x00' + _varint(len(tok)) + tok
+
+    def _decode(self, s, i):
+        n, i = _read_varint(s, i)
+        if n:
+            return self.vocabulary[n-1], i
+        length, i = _read_varint(s, i)
+        return s[i:i+length], i+length
+
+    def key(self, toks):
+        """[str] -> row key"""
+        return '\x00' + ''.join(self._encode(tok) for tok in toks)
+
+    def unkey(self, key):
+        """row key -> tuple(str)"""
+        toks = []
+        i = 1
+        while i < len(key):
+            tok, i = self._decode(key, i)
+            toks.append(tok)
+        return tuple(toks)
+
+    def column(self, tok):
+        """str -> column name"""
+        return self._encode(tok)
+
+    def uncolumn(self, column):
+        """column name -> str"""
+        return self._decode(column, 0)[0]
+
+    def owns(self, key):
+        """Whether a row key is in this encoding"""
+        return key.startswith('\x00')
+
+def _key_codec(backend, options):
+    """The key encoding asked for by the `keys' option: strings (the
+       default) or compact, which needs a vocabulary to have been
+       saved with build_vocabulary"""
+    keys = options.get('keys', 'strings')
+    if keys == 'strings':
+        return StringKeys()
+    elif keys == 'compact':
+        vocabulary = backend.load_vocabulary()
+        if vocabulary is None:
+            raise ValueError("keys=compact needs a vocabulary, see build_vocabulary")
+        return CompactKeys(vocabulary)
+    raise ValueError("Unknown key encoding %r" % (keys,))
+
+def build_vocabulary(cache, size = 64*1024):
+    """Pick the `size' most frequent tokens in `cache' by their
+       follower counts and save them as its vocabulary for
+       keys=compact. The first 127 get one-byte IDs and the first 16k
+       two-byte IDs"""
+    counts = {}
+    for preds, followers in cache.all_followers():
+        for tok, count in followers.iteritems():
+            counts[tok] = counts.get(tok, 0) + count
+        for tok in preds:
+            counts.setdefault(tok, 0)
+    vocabulary = sorted(counts, key = lambda tok: (-counts[tok], tok))[:size]
+    cache.save_vocabulary(vocabulary)
+    return vocabulary
+
+def migrate_keys(cache, batch_size = 500, progress = None):
+    """Rewrite the string-keyed chains in `cache', a backend opened
+       with keys=compact, with compact keys. The bots should be stopped
+       while it runs, since chains are only read in one encoding.
+       Returns the number of chains rewritten"""
+    # the compact rows are incremented by what they're short of rather
+    # than by the whole count, so that running it again after it's
+    # been interrupted between the copy and the delete doesn't count
+    # those rows twice. That works for counter column families too,
+    # which can't be set
+    old = StringKeys()
+    migrated = 0
+    for rows in _ichunks(cache._all_followers(old), batch_size):
+        rows = dict(rows)
+        stored = cache._stored(cache.codec, rows)
+        deltas = {}
+        for preds, followers in rows.iteritems():
+            short = dict((tok, count - stored[preds].get(tok, 0))
+                         for (tok, count) in followers.iteritems()
+                         if count != stored[preds].get(tok, 0))
+            if short:
+                deltas[preds] = short
+        cache.incr_followers_bulk(deltas)
+        cache._delete(old, list(rows))
+        migrated += len(rows)
+        if progress:
+            progress(migrated)
+    return migrated
+
+# The init_args of the networked backends can end with key=value
+# options for their connections:
+#
+# * pool_size: the most connections to open (Redis, Cassandra)
+# * timeout: the socket timeout, in seconds
+# * retries: how many times to retry a failed request
+# * backoff: seconds to wait before the first retry, doubling after
+#   each one (Redis, CouchDB)
+# * keys: how chains are keyed, `strings' (the default) or `compact'
+#   (Redis, Cassandra), see CompactKeys
+#
+# e.g. "localhost,6379,0,pool_size=20,timeout=2". The connection pool
+# is shared by every backend instance (and so every thread) in the
+# process with the same init_args
+def _parse_init_args(init_args):
+    """str -> ([positional arg], dict(option -> str))"""
+    args = []
+    options = {}
+    for arg in init_args.split(','):
+        if '=' in arg:
+            k, v = arg.split('=', 1)
+            options[k.strip()] = v.strip()
+        else:
+            args.append(arg)
+    return args, options
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def _shared_client(key, make):
+    """Return the client stored under `key', calling `make' to create
+       it if there isn't one yet"""
+    # keyed on the pid too, so that forked workers (generate_batch)
+    # make their own rather than sharing the parent's sockets
+    key = (os.getpid(), key)
+    with _clients_lock:
+        try:
+            return _clients[key]
+        except KeyError:
+            _clients[key] = client = make()
+            return client
+
+class _Retrying(object):
+    # Proxies `client', retrying calls to its methods that raise one
+    # of `exceptions' up to `retries' times. Pipelines are recorded
+    # and replayed on a fresh one when execute() fails. Any of the
+    # errors (a timeout, or the connection closing while the replies
+    # are read) can come after the server has run the commands, so
+    # calls and pipelines with `non_idempotent' commands in them,
+    # which would then be applied twice, are only sent once. A
+    # retried `ping' goes first, so they still ride out the server
+    # being unreachable
+    def __init__(self, client, exceptions, retries, backoff,
+                 non_idempotent = ()):
+        self.client = client
+        self.exceptions = exceptions
+        self.retries = retries
+        self.backoff = backoff
+        self.non_idempotent = frozenset(non_idempotent)
+
+    def _retry(self, fn, names):
+        """Call `fn', which runs the commands `names', retrying it
+           if that's safe"""
+        if self.non_idempotent.intersection(names):
+            if self.retries:
+                self._retry(self.client.ping, ['ping'])
+            return fn()
+        delay = self.backoff
+        for attempt in range(self.retries):
+            try:
+                return fn()
+            except self.exceptions:
+                time.sleep(delay)
+                delay *= 2
+        return fn()
+
+    def pipeline(self, *a, **kw):
+        return _RetryingPipeline(self, a, kw)
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if not callable(attr):
+            return attr
+
+        def call(*a, **kw):
+            return self._retry(lambda: attr(*a, **kw), [name])
+        return call
+
+class _RetryingPipeline(object):
+    # Queues commands like a pipeline, sending them on a new pipeline
+    # of the _Retrying's client on execute() so that the whole batch
+    # can be retried
+    def __init__(self, retrying, args, kwargs):
+        self.retrying = retrying
+        self.args = args
+        self.kwargs = kwargs
+        self.commands = []
+
+    def __getattr__(self, name):
+        def queue(*a, **kw):
+            self.commands.append((name, a, kw))
+            return self
+        return queue
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+
+        def run():
+            pipe = self.retrying.client.pipeline(*self.args, **self.kwargs)
+            for name, a, kw in commands:
+                getattr(pipe, name)(*a, **kw)
+            return pipe.execute()
+        return self.retrying._retry(run, [name for (name, a, kw) in commands])
+
+class BloomFilter(object):
+    # A Bloom filter sized for `capacity' keys at a false-positive
+    # rate of `error_rate'
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.nbits = int(math.ceil(-capacity * math.log(error_rate)
+                                   / math.log(2) ** 2))
+        self.nhashes = max(1, int(round(self.nbits * math.log(2) / capacity)))
+        self.bits = bytearray((self.nbits + 7) // 8)
+        self.count = 0
+
+    def _indexes(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        # double hashing with the two halves of an md5
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(str(key)).digest())
+        for i in range(self.nhashes):
+            yield (h1 + i * h2) % self.nbits
+
+    def add(self, key):
+        for i in self._indexes(key):
+            self.bits[i >> 3] |= 1 << (i & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[i >> 3] & (1 << (i & 7))
+                   for i in self._indexes(key))
+
+class SeenFilter(object):
+    # A local front for the seen-sets in the stores, holding the last
+    # `generations' Bloom filters of `capacity' keys each so that its
+    # size is bounded. A key in it has definitely been acked to the
+    # store (or is a false positive, with probability `error_rate',
+    # and will be skipped), so only keys that aren't need to be
+    # looked up remotely
+    def __init__(self, capacity = 100*1000, generations = 2, error_rate = 1e-5):
+        self.capacity = capacity
+        self.generations = generations
+        self.error_rate = error_rate
+        self.filters = [BloomFilter(capacity, error_rate)]
+
+    def add(self, key):
+        if self.filters[0].count >= self.capacity:
+            self.filters.insert(0, BloomFilter(self.capacity, self.error_rate))
+            del self.filters[self.generations:]
+        self.filters[0].add(key)
+
+    def __contains__(self, key):
+        return any(key in f for f in self.filters)
+
+def _filter_seen(cache, it, key, batch_size = 100):
+    """The seen_iterator shared by the backends: yield the items in
+       `it' that haven't been seen, looking up batches of keys that
+       aren't in the local seen_filter with one seen_many call and
+       acking them with one saw_many"""
+    # this filter errs on the side of acking an item before it's
+    # been processed.
+    for batch in _ichunks(it, batch_size):
+        unknown = []
+        unknown_keys = set()
+        for x in batch:
+            seen_key = key(x)
+            if seen_key not in cache.seen_filter and seen_key not in unknown_keys:
+                unknown.append((seen_key, x))
+                unknown_keys.add(seen_key)
+        if not unknown:
+            continue
+
+        seen = cache.seen_many([seen_key for (seen_key, x) in unknown])
+        new = [(seen_key, x)
+               for ((seen_key, x), was_seen)
+               in zip(unknown, seen)
+               if not was_seen]
+        if new:
+            cache.saw_many([seen_key for (seen_key, x) in new])
+        for seen_key in unknown_keys:
+            cache.seen_filter.add(seen_key)
+
+        for seen_key, x in new:
+            yield x
+
+def _filter_cursor(cache, it, source, key, seen_key):
+    """The cursor_iterator shared by the backends: yield the items in
+       `it' whose key(x) is greater than the stored cursor for
+       `source', advancing the cursor to the greatest of them. Items
+       without a key (key(x) is None), and every item on the first
+       run for a source, fall back to seen_iterator with `seen_key'.
+       Keys needn't be unique (BBC timestamps are only to the second),
+       so the items whose key is the old or the new cursor go to
+       seen_iterator too, so that items sharing a key with the cursor
+       are neither dropped nor repeated"""
+    keyed = [(key(x), x) for x in it]
+    cursor = cache.get_cursor(source)
+    keys = [k for (k, x) in keyed if k is not None]
+    newcursor = max(keys) if keys else None
+
+    new = []
+    fallback = []
+    for k, x in keyed:
+        if k is None or cursor is None or k == cursor or k == newcursor:
+            fallback.append(x)
+        elif k > cursor:
+            new.append(x)
+
+    # like seen_iterator, this errs on the side of acking items before
+    # they've been processed
+    if keys and (cursor is None or newcursor > cursor):
+        cache.set_cursor(source, newcursor)
+
+    for x in new:
+        yield x
+    if fallback:
+        for x in cache.seen_iterator(fallback, seen_key):
+            yield x
 
 class Cassandra(object):
     # Types:
     # * tokenlist() -> [Token]
     # * hashedtoken()
 
+    # seconds to remember seen keys for
+    seen_ttl = 30*24*60*60
+
     def __init__(self, init_args):
         import pycassa
-        import cassandra.ttypes
+        self.NotFoundException = pycassa.NotFoundException
 
-        seed, keyspace, column_family,seen_cf = init_args.split(',')
-        self.seeds = [seed]
+        # the seed can be a ;-separated list of servers. An optional
+        # fifth argument of `counters' says that the followers CF is a
+        # counter column family (with a default_validation_class of
+        # CounterColumnType)
+        args, options = _parse_init_args(init_args)
+        seeds, keyspace, column_family, seen_cf = args[:4]
+        self.counters = 'counters' in args[4:]
+        self.seeds = seeds.split(';')
         self.keyspace = keyspace
         self.column_family = column_family
 
-        self.client = pycassa.connect_thread_local(self.seeds)
-        self.cf = pycassa.ColumnFamily(self.client, self.keyspace,
-                                       self.column_family)
-        self.seen_cf = pycassa.ColumnFamily(self.client, self.keyspace,
-                                            seen_cf)
+        pool_args = {}
+        if 'pool_size' in options:
+            pool_args['pool_size'] = int(options['pool_size'])
+        if 'timeout' in options:
+            pool_args['timeout'] = float(options['timeout'])
+        if 'retries' in options:
+            pool_args['max_retries'] = int(options['retries'])
+        self.pool = _shared_client(('Cassandra', init_args),
+                                   lambda: pycassa.ConnectionPool(keyspace, self.seeds,
+                                                                  **pool_args))
+        self.cf = pycassa.ColumnFamily(self.pool, self.column_family)
+        self.seen_cf = pycassa.ColumnFamily(self.pool, seen_cf)
+        self.seen_filter = SeenFilter()
+        # keys=compact needs the followers CF to have a BytesType
+        # comparator, since the column names aren't text
+        self.codec = _key_codec(self, options)
 
     def _hash_tokens(self, tokens):
         """tokenlist() -> hashedtoken()"""
-        return ' '.join(tok.tok.encode('utf-8') for tok in tokens)
+        return self.codec.key(tok.tok for tok in tokens)
+
+    def _followers(self, stored):
+        # counters that cleanup has taken down to 0 (or below, if
+        # it raced with ingest) are left in place, so skip them
+        uncolumn = self.codec.uncolumn
+        return dict((Token(uncolumn(k)), int(v))
+                    for (k, v)
+                    in stored.iteritems()
+                    if int(v) > 0)
 
     def get_followers(self, keys):
         """get_followers([tokenlist()]) -> dict(Token -> count)"""
@@ -32,81 +481,253 @@ class Cassandra(object):
             # TODO: handle the case that there are more than 10k
             # columns available (the current behaviour is that we take
             # the 10k ASCIIbetically first ones)
-            return dict((Token(k), int(v))
-                        for (k, v)
-                        in stored.iteritems())
-        except (cassandra.ttypes.NotFoundException, KeyError, ValueError):
+            return self._followers(stored)
+        except (self.NotFoundException, KeyError, ValueError):
             return {}
 
+    def get_followers_multi(self, keys_list):
+        """get_followers_multi([[tokenlist()]]) -> [dict(Token -> count)]"""
+        # one multiget for every chain length instead of a get each
+        hkeys = [self._hash_tokens(keys) for keys in keys_list]
+        stored = self.cf.multiget(hkeys, column_count=10*1000)
+        ret = []
+        for hkey in hkeys:
+            try:
+                ret.append(self._followers(stored.get(hkey, {})))
+            except ValueError:
+                ret.append({})
+        return ret
+
     def incr_follower(self, preds, token):
         """incr_followers([token()], token())"""
-        # these incrs are unsafe, but redditron is not a bank
         hpreds = self._hash_tokens(preds)
+        column = self.codec.column(token.tok)
+        if self.counters:
+            # counter increments are done on the server without
+            # reading the row
+            self.cf.add(hpreds, column)
+            return
+
+        # these incrs are unsafe, but redditron is not a bank
         try:
-            existing = int(self.cf.get(hpreds)[token.tok])
-        except (cassandra.ttypes.NotFoundException, KeyError, ValueError):
+            existing = int(self.cf.get(hpreds)[column])
+        except (self.NotFoundException, KeyError, ValueError):
             existing = 0
-        self.cf.insert(hpreds, {token.tok: str(existing+1)})
+        self.cf.insert(hpreds, {column: str(existing+1)})
+
+    def incr_followers_bulk(self, deltas):
+        """incr_followers_bulk(dict(tuple(str) -> dict(str -> count)))"""
+        # one multiget and one batch_insert per chunk of rows instead
+        # of a get and an insert per follower. Just as unsafe as
+        # incr_follower
+        key, column = self.codec.key, self.codec.column
+        hdeltas = dict((key(preds), dict((column(tok), count)
+                                         for (tok, count)
+                                         in followers.iteritems()))
+                       for (preds, followers)
+                       in deltas.iteritems())
+
+        if self.counters:
+            # inserts into a counter CF are increments, so there's
+            # nothing to read
+            b = self.cf.batch(queue_size = 500)
+            for hpreds, followers in hdeltas.iteritems():
+                b.insert(hpreds, followers)
+            b.send()
+            return
+
+        for hkeys in _chunks(hdeltas.keys(), 100):
+            # only the columns being incremented, which also means
+            # rows with more than 10k followers aren't truncated
+            columns = set()
+            for hpreds in hkeys:
+                columns.update(hdeltas[hpreds])
+            existing = self.cf.multiget(hkeys, columns=sorted(columns))
+            inserts = {}
+            for hpreds in hkeys:
+                row = existing.get(hpreds, {})
+                columns = {}
+                for tok, count in hdeltas[hpreds].iteritems():
+                    try:
+                        count += int(row.get(tok, 0))
+                    except ValueError:
+                        pass
+                    columns[tok] = str(count)
+                inserts[hpreds] = columns
+            self.cf.batch_insert(inserts)
+
+    def set_followers(self, values):
+        """set_followers(dict(tuple(str) -> dict(str -> count)))"""
+        if self.counters:
+            raise NotImplementedError("Counter columns can only be incremented")
+        key, column = self.codec.key, self.codec.column
+        self.cf.batch_insert(dict((key(preds), dict((column(tok), str(count))
+                                                    for (tok, count)
+                                                    in followers.iteritems()))
+                                  for (preds, followers)
+                                  in values.iteritems()))
+
+    def delete_followers(self, keys):
+        """delete_followers([tuple(str)])"""
+        self._delete(self.codec, keys)
+
+    def _stored(self, codec, rows):
+        """The counts stored in the encoding `codec' for the followers
+           in `rows', a dict(tuple(str) -> dict(str -> count)), as the
+           same sort of dict"""
+        hkeys = dict((codec.key(preds), preds) for preds in rows)
+        columns = set()
+        for followers in rows.itervalues():
+            columns.update(codec.column(tok) for tok in followers)
+        stored = self.cf.multiget(list(hkeys), columns=sorted(columns))
+        ret = dict((preds, {}) for preds in rows)
+        for hkey, found in stored.iteritems():
+            ret[hkeys[hkey]] = dict((codec.uncolumn(k), int(v))
+                                    for (k, v) in found.iteritems())
+        return ret
+
+    def _delete(self, codec, keys):
+        b = self.cf.batch(queue_size = 500)
+        for preds in keys:
+            b.remove(codec.key(preds))
+        b.send()
 
     def saw(self, key):
-        # TODO: we have a way to clean up the Followers CF, but not
-        # the Seen CF. This can be tricky because we want e.g. the
-        # Twitter DM box to never be processed twice (because it has
-        # stateful commands in it). This could be simplified to just
-        # store a single key since both Twitter and reddit can say
-        # "give me the messages that arrived after this ID', but
-        # reddit's `before` parameter doesn't deal well with the case
-        # that a lot of messages have arrived since the item in the
-        # `before` param.
-        self.seen_cf.insert(key, {'seen': '1'})
+        self.saw_many([key])
+
+    def saw_many(self, keys):
+        # The Seen CF is kept from growing forever by giving its
+        # columns a TTL. That has to be longer than anything can
+        # reappear for, because we want e.g. the Twitter DM box to
+        # never be processed twice (because it has stateful commands
+        # in it). This could be simplified to just store a single key
+        # since both Twitter and reddit can say "give me the messages
+        # that arrived after this ID', but reddit's `before` parameter
+        # doesn't deal well with the case that a lot of messages have
+        # arrived since the item in the `before` param.
+        b = self.seen_cf.batch(queue_size = 500)
+        for key in keys:
+            b.insert(key, {'seen': '1'}, ttl = self.seen_ttl)
+        b.send()
 
     def seen(self, key):
-        try:
-            return self.seen_cf.get(key, columns=['seen'])['seen'] == '1'
-        except (cassandra.ttypes.NotFoundException, KeyError), e:
-            return False
+        return self.seen_many([key])[0]
+
+    def seen_many(self, keys):
+        stored = self.seen_cf.multiget(keys, columns=['seen'])
+        return [stored.get(key, {}).get('seen') == '1'
+                for key in keys]
 
     def seen_iterator(self, it, key = lambda x: x):
-        # this filter errs on the side of acking an item before it's
-        # been processed.
-        for x in it:
-            seen_key = key(x)
-            if not self.seen(seen_key):
-                self.saw(seen_key)
-                yield x
-
-    def cleanup(self, decr):
-        # Note! neither this nor incr_followers are atomic. We can
-        # definitely get bad data this way if both are running at the
-        # same time
+        return _filter_seen(self, it, key)
+
+    def cursor_iterator(self, it, source, key, seen_key = lambda x: x):
+        return _filter_cursor(self, it, source, key, seen_key)
+
+    def get_cursor(self, source):
+        """get_cursor(str) -> int or None"""
+        stored = self.seen_cf.multiget(['_cursors'], columns=[source])
+        cursor = stored.get('_cursors', {}).get(source)
+        return long(cursor) if cursor is not None else None
+
+    def set_cursor(self, source, value):
+        self.seen_cf.insert('_cursors', {source: str(value)})
+
+    def load_vocabulary(self):
+        """load_vocabulary() -> [str] or None"""
+        try:
+            return json.loads(self.seen_cf.get('_vocabulary')['tokens'])
+        except (self.NotFoundException, KeyError):
+            return None
+
+    def save_vocabulary(self, vocabulary):
+        if self.load_vocabulary() is not None:
+            raise ValueError("There's already a vocabulary")
+        self.seen_cf.insert('_vocabulary', {'tokens': json.dumps(vocabulary)})
+
+    def _rows(self, page_size = 1000):
+        """Yield (key, columns) for every row in the followers CF,
+           paging through the columns of rows wider than `page_size'"""
+        for key, columns in self.cf.get_range(column_count = page_size,
+                                              buffer_size = page_size):
+            page = columns
+            while len(page) >= page_size:
+                # column_start is inclusive, so ask for one more and
+                # drop the column we already have
+                last = page.keys()[-1]
+                page = self.cf.get(key, column_start = last,
+                                   column_count = page_size+1)
+                page.pop(last, None)
+                columns.update(page)
+            yield key, columns
+
+    def all_followers(self):
+        """all_followers() -> iter((tuple(str), dict(str -> count)))"""
+        return self._all_followers(self.codec)
+
+    def _all_followers(self, codec):
+        for key, columns in self._rows():
+            if codec.owns(key):
+                followers = dict((codec.uncolumn(k), int(v))
+                                 for (k, v)
+                                 in columns.iteritems()
+                                 if int(v) > 0)
+                if followers:
+                    yield codec.unkey(key), followers
+
+    def cleanup(self, decr, progress = None, batch_size = 500):
+        # Note! without counters, neither this nor incr_followers are
+        # atomic. We can definitely get bad data this way if both are
+        # running at the same time. Counter columns can't be safely
+        # removed while they're being incremented, so in counters mode
+        # the ones that run out are decremented to 0 rather than
+        # removed, and reads skip them; that's safe alongside ingest,
+        # but the columns stay behind
         all_decrs = 0
         all_removals = 0
         all_keys_modified = 0
-        for key, columns in self.cf.get_range(column_count = 10*1000):
-            # TODO: detect that we got 10k columns and continue doing
-            # requests until we've processed them all
-            inserts = {}
-            removals = []
-            for fs, count in columns.iteritems():
-                count = long(count)
-                if count > decr:
-                    inserts[fs] = str(count - decr)
-                else:
-                    removals.append(fs)
+        all_rows = 0
+        for rows in _ichunks(self._rows(), batch_size):
+            # the writes for each batch of rows go out together
+            b = self.cf.batch(queue_size = batch_size)
+            for key, columns in rows:
+                inserts = {}
+                removals = []
+                for fs, count in columns.iteritems():
+                    count = long(count)
+                    if self.counters:
+                        # counter inserts are increments
+                        if count <= 0:
+                            continue
+                        elif count <= decr:
+                            inserts[fs] = -count
+                            all_removals += 1
+                        else:
+                            inserts[fs] = -decr
+                            all_decrs += 1
+                    elif count <= decr:
+                        removals.append(fs)
+                    else:
+                        inserts[fs] = str(count - decr)
+                        all_decrs += 1
 
-            if removals:
-                # delete the keys for which decring their counts would
-                # cause them to disappear
-                self.cf.remove(key, removals)
-                all_removals += len(removals)
+                if removals:
+                    # delete the keys for which decring their counts would
+                    # cause them to disappear
+                    b.remove(key, removals)
+                    all_removals += len(removals)
 
-            if inserts:
-                # and decr the others
-                self.cf.insert(key, inserts)
-                all_decrs += len(inserts)
+                if inserts:
+                    # and decr the others
+                    b.insert(key, inserts)
 
-            if removals or inserts:
-                all_keys_modified += 1
+                if removals or inserts:
+                    all_keys_modified += 1
+            b.send()
+
+            all_rows += len(rows)
+            if progress:
+                progress(all_rows, all_decrs, all_removals, all_keys_modified)
 
         return all_decrs, all_removals, all_keys_modified
 
@@ -115,75 +736,225 @@ class Redis(object):
     # * tokenlist() -> [Token]
     # * hashedtoken()
 
+    # seen keys go into one set per `seen_period' seconds, which
+    # expire after `seen_generations' periods
+    seen_period = 7*24*60*60
+    seen_generations = 4
+
     def __init__(self, init_args):
         import redis
 
-        host, port, db_num = init_args.split(',')
-        self.client = redis.Redis(host, int(port), int(db_num))
+        args, options = _parse_init_args(init_args)
+        host, port, db_num = args
+
+        def make_client():
+            pool_args = {}
+            if 'pool_size' in options:
+                pool_args['max_connections'] = int(options['pool_size'])
+            if 'timeout' in options:
+                pool_args['socket_timeout'] = float(options['timeout'])
+            pool = redis.ConnectionPool(host=host, port=int(port), db=int(db_num),
+                                        **pool_args)
+            return _Retrying(redis.Redis(connection_pool=pool),
+                             (redis.ConnectionError, redis.TimeoutError),
+                             int(options.get('retries', 0)),
+                             float(options.get('backoff', 0.1)),
+                             non_idempotent = ('hincrby', 'hincrbyfloat',
+                                               'incr', 'incrby', 'decr',
+                                               'decrby'))
+        self.client = _shared_client(('Redis', init_args), make_client)
+        self.seen_filter = SeenFilter()
+        self.codec = _key_codec(self, options)
 
     def _hash_tokens(self, tokens):
         """tokenlist() -> hashedtoken()"""
-        return ' '.join(tok.tok.encode('utf-8') for tok in tokens)
+        return self.codec.key(tok.tok for tok in tokens)
 
-    def get_followers(self, keys):
-        """get_followers([tokenlist()]) -> dict(Token -> count)"""
-        stored = self.client.hgetall(self._hash_tokens(keys))
-        return dict((Token(k), int(v))
+    def _followers(self, stored):
+        uncolumn = self.codec.uncolumn
+        return dict((Token(uncolumn(k)), int(v))
                     for (k, v)
                     in stored.iteritems())
 
+    def get_followers(self, keys):
+        """get_followers([tokenlist()]) -> dict(Token -> count)"""
+        return self._followers(self.client.hgetall(self._hash_tokens(keys)))
+
+
+    def get_followers_multi(self, keys_list):
+        """get_followers_multi([[tokenlist()]]) -> [dict(Token -> count)]"""
+        # one pipelined round trip for every chain length
+        pipe = self.client.pipeline(transaction=False)
+        for keys in keys_list:
+            pipe.hgetall(self._hash_tokens(keys))
+        return [self._followers(stored) for stored in pipe.execute()]
 
     def incr_follower(self, preds, token):
         """incr_followers([token()], token())"""
         # incrs are atomic in redis
         hpreds = self._hash_tokens(preds)
-        self.client.hincrby(hpreds, token.tok, 1)
+        self.client.hincrby(hpreds, self.codec.column(token.tok), 1)
+
+    def incr_followers_bulk(self, deltas):
+        """incr_followers_bulk(dict(tuple(str) -> dict(str -> count)))"""
+        # a single round trip for the whole batch
+        key, column = self.codec.key, self.codec.column
+        pipe = self.client.pipeline(transaction=False)
+        for preds, followers in deltas.iteritems():
+            hpreds = key(preds)
+            for tok, count in followers.iteritems():
+                pipe.hincrby(hpreds, column(tok), count)
+        pipe.execute()
+
+    def set_followers(self, values):
+        """set_followers(dict(tuple(str) -> dict(str -> count)))"""
+        key, column = self.codec.key, self.codec.column
+        pipe = self.client.pipeline(transaction=False)
+        for preds, followers in values.iteritems():
+            hpreds = key(preds)
+            for tok, count in followers.iteritems():
+                pipe.hset(hpreds, column(tok), count)
+        pipe.execute()
+
+    def delete_followers(self, keys):
+        """delete_followers([tuple(str)])"""
+        self._delete(self.codec, keys)
+
+    def _stored(self, codec, rows):
+        """The counts stored in the encoding `codec' for the followers
+           in `rows', a dict(tuple(str) -> dict(str -> count)), as the
+           same sort of dict"""
+        keys = list(rows)
+        pipe = self.client.pipeline(transaction=False)
+        for preds in keys:
+            pipe.hgetall(codec.key(preds))
+        return dict((preds, dict((codec.uncolumn(k), int(v))
+                                 for (k, v) in stored.iteritems()))
+                    for (preds, stored) in zip(keys, pipe.execute()))
+
+    def _delete(self, codec, keys):
+        for chunk in _chunks(keys, 500):
+            self.client.delete(*[codec.key(preds) for preds in chunk])
+
+    def _seen_sets(self):
+        """The names of the live seen-sets, newest first"""
+        period = int(time.time() // self.seen_period)
+        return ['_redikov_seen_%d' % (period - i)
+                for i in range(self.seen_generations)]
 
     def saw(self, key):
-        self.client.sadd('_redikov_seen', key)
+        self.saw_many([key])
+
+    def saw_many(self, keys):
+        current = self._seen_sets()[0]
+        pipe = self.client.pipeline(transaction=False)
+        pipe.sadd(current, *keys)
+        pipe.expire(current, self.seen_period * self.seen_generations)
+        pipe.execute()
 
     def seen(self, key):
-        return self.client.sismember('_redikov_seen', key)
+        return self.seen_many([key])[0]
+
+    def seen_many(self, keys):
+        # _redikov_seen is the unbounded set from before the
+        # seen-sets were split up
+        sets = self._seen_sets() + ['_redikov_seen']
+        pipe = self.client.pipeline(transaction=False)
+        for key in keys:
+            for name in sets:
+                pipe.sismember(name, key)
+        results = pipe.execute()
+        return [any(results[i:i+len(sets)])
+                for i in range(0, len(results), len(sets))]
 
     def seen_iterator(self, it, key = lambda x: x):
-        # this filter errs on the side of acking an item before it's
-        # been processed.
-        for x in it:
-            seen_key = key(x)
-            if not self.seen(seen_key):
-                self.saw(seen_key)
-                yield x
+        return _filter_seen(self, it, key)
+
+    def cursor_iterator(self, it, source, key, seen_key = lambda x: x):
+        return _filter_cursor(self, it, source, key, seen_key)
+
+    def get_cursor(self, source):
+        """get_cursor(str) -> int or None"""
+        cursor = self.client.hget('_redikov_cursors', source)
+        return long(cursor) if cursor is not None else None
+
+    def set_cursor(self, source, value):
+        self.client.hset('_redikov_cursors', source, str(value))
+
+    def load_vocabulary(self):
+        """load_vocabulary() -> [str] or None"""
+        stored = self.client.get('_redikov_vocabulary')
+        return json.loads(stored) if stored is not None else None
+
+    def save_vocabulary(self, vocabulary):
+        if not self.client.setnx('_redikov_vocabulary', json.dumps(vocabulary)):
+            raise ValueError("There's already a vocabulary")
+
+    def _follower_keys(self):
+        # SCAN rather than KEYS, which blocks the server while it
+        # builds the list of every key
+        for key in self.client.scan_iter(count = 1000):
+            if not key.startswith('_redikov_'):
+                yield key
 
-    def cleanup(self, decr):
+    def _hgetall_batches(self, batch_size):
+        """Yield lists of (key, dict(str -> str)) for all of the
+           follower hashes, fetching each batch in one round trip"""
+        for keys in _ichunks(self._follower_keys(), batch_size):
+            pipe = self.client.pipeline(transaction=False)
+            for key in keys:
+                pipe.hgetall(key)
+            yield zip(keys, pipe.execute())
+
+    def all_followers(self):
+        """all_followers() -> iter((tuple(str), dict(str -> count)))"""
+        return self._all_followers(self.codec)
+
+    def _all_followers(self, codec):
+        for rows in self._hgetall_batches(500):
+            for key, stored in rows:
+                if codec.owns(key):
+                    yield codec.unkey(key), dict((codec.uncolumn(k), int(v))
+                                                 for (k, v)
+                                                 in stored.iteritems())
+
+    def cleanup(self, decr, progress = None, batch_size = 500):
         all_decrs = 0
         all_removals = 0
         all_keys_modified = 0
-        for key in self.client.keys():
-            if key == '_redikov_seen':
-                continue
-            inserts = {}
-            removals = []
-            for fs, count in self.client.hgetall(key).iteritems():
-                count = long(count)
-                if count > decr:
-                    inserts[fs] = count - decr
-                else:
-                    removals.append(fs)
+        all_rows = 0
+        for rows in self._hgetall_batches(batch_size):
+            pipe = self.client.pipeline(transaction=False)
+            for key, stored in rows:
+                decrs = []
+                removals = []
+                for fs, count in stored.iteritems():
+                    if long(count) > decr:
+                        decrs.append(fs)
+                    else:
+                        removals.append(fs)
 
-            if removals:
-                # delete the keys for which decring their counts would
-                # cause them to disappear
-                for removal in removals:
-                    self.client.hdel(key, removal)
-                all_removals += len(removals)
+                if removals:
+                    # delete the keys for which decring their counts would
+                    # cause them to disappear
+                    pipe.hdel(key, *removals)
+                    all_removals += len(removals)
 
-            if inserts:
-                # and decr the others
-                self.client.hmset(key, inserts)
-                all_decrs += len(inserts)
+                if decrs:
+                    # and decr the others. HINCRBY rather than setting
+                    # the new value so that increments made since we
+                    # read the hash aren't lost
+                    for fs in decrs:
+                        pipe.hincrby(key, fs, -decr)
+                    all_decrs += len(decrs)
 
-            if removals or inserts:
-                all_keys_modified += 1
+                if removals or decrs:
+                    all_keys_modified += 1
+            pipe.execute()
+
+            all_rows += len(rows)
+            if progress:
+                progress(all_rows, all_decrs, all_removals, all_keys_modified)
 
         return all_decrs, all_removals, all_keys_modified
 
@@ -191,22 +962,83 @@ class CouchDB(object):
     # Types:
     # * tokenlist() -> [Token]
     # * hashedtoken()
+    # increments are applied on the server by this update handler, so
+    # that a document doesn't have to be fetched to increment it
+    design_id = '_design/redditron'
+    incr_handler = """function(doc, req) {
+        var counts = JSON.parse(req.body);
+        if (!doc) {
+            doc = {_id: req.id};
+        }
+        for (var tok in counts) {
+            doc[tok] = (doc[tok] || 0) + counts[tok];
+        }
+        return [doc, 'ok'];
+    }"""
+    # and set_followers by this one
+    set_handler = """function(doc, req) {
+        var counts = JSON.parse(req.body);
+        if (!doc) {
+            doc = {_id: req.id};
+        }
+        for (var tok in counts) {
+            doc[tok] = counts[tok];
+        }
+        return [doc, 'ok'];
+    }"""
+    # update handlers and _bulk_docs can still conflict with other
+    # writers, in which case we try again this many times
+    conflict_retries = 5
+    # seconds to remember seen keys for, see expire_seen
+    seen_ttl = 30*24*60*60
+    # the document in the seen DB holding the cursors
+    cursors_id = 'cursors'
+
     def __init__(self, init_args):
+        import couchdb.http
+        self.couchdb = couchdb
+
+        args, options = _parse_init_args(init_args)
+        db_uri, db_name = args
 
-        from couchdb.client import Server, Database, ResourceConflict, PreconditionFailed, ResourceNotFound
+        def make_server():
+            # couchdb's sessions keep their own (unbounded) pool of
+            # connections, so pool_size isn't supported
+            session_args = {}
+            if 'timeout' in options:
+                session_args['timeout'] = float(options['timeout'])
+            backoff = float(options.get('backoff', 0.1))
+            session_args['retry_delays'] = [backoff * 2 ** i for i
+                                            in range(int(options.get('retries', 0)))]
+            session = self.couchdb.http.Session(**session_args)
+            return self.couchdb.Server(db_uri, session=session)
+        self.server = _shared_client(('CouchDB', db_uri, tuple(sorted(options.items()))),
+                                     make_server)
 
-        db_uri, db_name = init_args.split(',')
-        self.db = self.get_db(db_uri, db_name)
-        self.seen_db = self.get_db(db_uri, db_name + "-seen")
+        self.db = self.get_db(db_name)
+        self.seen_db = self.get_db(db_name + "-seen")
+        self.seen_filter = SeenFilter()
+        self._ensure_design()
 
-    def get_db(self, db_uri, db_name):
-        server = Server(db_uri)
+    def get_db(self, db_name):
+        server = self.server
         try:
             db = server[db_name]
-        except ResourceNotFound:
+        except self.couchdb.ResourceNotFound:
             db = server.create(db_name)
         return db
 
+    def _ensure_design(self):
+        design = self.db.get(self.design_id) or {'_id': self.design_id}
+        updates = {'incr': self.incr_handler, 'set': self.set_handler}
+        if design.get('updates') != updates:
+            design['updates'] = updates
+            try:
+                self.db.save(design)
+            except self.couchdb.ResourceConflict:
+                # someone else is installing it
+                pass
+
     def _hash_tokens(self, tokens):
         """tokenlist() -> hashedtoken()"""
         return ' '.join(tok.tok.encode('utf-8') for tok in tokens)
@@ -222,38 +1054,1433 @@ class CouchDB(object):
                     in stored.iteritems() if k != '_rev' and k != '_id')
 
 
+    def get_followers_multi(self, keys_list):
+        """get_followers_multi([[tokenlist()]]) -> [dict(Token -> count)]"""
+        # one _all_docs request for every chain length
+        rows = self.db.view('_all_docs', include_docs=True,
+                            keys=[self._hash_tokens(keys) for keys in keys_list])
+        return [dict((Token(k), int(v))
+                     for (k, v)
+                     in (row.doc or {}).iteritems() if k != '_rev' and k != '_id')
+                for row in rows]
+
+    def _update(self, handler, hpreds, followers):
+        body = json.dumps(followers)
+        for attempt in range(self.conflict_retries):
+            try:
+                self.db.update_doc(handler, hpreds, body=body)
+                return
+            except self.couchdb.ResourceConflict:
+                metrics.incr('couchdb.conflicts')
+        # the last conflict goes to the caller rather than losing the
+        # write
+        self.db.update_doc(handler, hpreds, body=body)
+
     def incr_follower(self, preds, token):
         """incr_followers([token()], token())"""
-        # these incrs are unsafe, but redditron is not a bank
-        hpreds = self._hash_tokens(preds)
-        try:
-            if hpreds in self.db:
-                orig = self.db[hpreds]
-                orig[token.tok] = orig.get(token.tok, 0) + 1
-                self.db[orig.id] = orig
+        self._update('redditron/incr', self._hash_tokens(preds), {token.tok: 1})
+
+    def incr_followers_bulk(self, deltas):
+        """incr_followers_bulk(dict(tuple(str) -> dict(str -> count)))"""
+        # fetch every document in the batch with one _all_docs request
+        # and write them all back with one _bulk_docs. The documents
+        # that conflicted with another writer are fetched and written
+        # again. If they still conflict after conflict_retries tries,
+        # or a document fails for any other reason, the error is
+        # raised; the rest of the batch has been written by then
+        hdeltas = [(_hash_toks(preds), followers)
+                   for (preds, followers)
+                   in deltas.iteritems()]
+        for chunk in _chunks(hdeltas, 500):
+            for attempt in range(self.conflict_retries):
+                rows = self.db.view('_all_docs', include_docs=True,
+                                    keys=[hpreds for (hpreds, followers) in chunk])
+                docs = []
+                # _all_docs returns the rows in the order of the keys
+                for (hpreds, followers), row in zip(chunk, rows):
+                    doc = row.doc or {'_id': hpreds}
+                    for tok, count in followers.iteritems():
+                        doc[tok] = doc.get(tok, 0) + count
+                    docs.append(doc)
+
+                results = self.db.update(docs)
+                failed = [(delta, error)
+                          for (delta, (success, docid, error))
+                          in zip(chunk, results)
+                          if not success]
+                errors = [error for (delta, error) in failed
+                          if not isinstance(error, self.couchdb.ResourceConflict)]
+                if errors:
+                    metrics.incr('couchdb.errors', len(errors))
+                    raise errors[0]
+                chunk = [delta for (delta, error) in failed]
+                if not chunk:
+                    break
+                metrics.incr('couchdb.conflicts', len(chunk))
             else:
-                self.db[hpreds] = {token.tok: 1}
-        except:
-            pass
-            #TODO: error-handling
+                raise self.couchdb.ResourceConflict(
+                    "%d documents still conflicted after %d tries"
+                    % (len(chunk), self.conflict_retries))
+
+    def set_followers(self, values):
+        """set_followers(dict(tuple(str) -> dict(str -> count)))"""
+        for preds, followers in values.iteritems():
+            self._update('redditron/set', _hash_toks(preds), followers)
+
+    def delete_followers(self, keys):
+        """delete_followers([tuple(str)])"""
+        for chunk in _chunks([_hash_toks(preds) for preds in keys], 500):
+            rows = self.db.view('_all_docs', keys=chunk)
+            self.db.update([{'_id': row.key, '_rev': row.value['rev'], '_deleted': True}
+                            for row in rows
+                            if 'error' not in row and not row.value.get('deleted')])
 
     def saw(self, key):
+        self.saw_many([key])
+
+    def saw_many(self, keys):
+        # keys that have already been seen just conflict
+        self.seen_db.update([{'_id': key, 'seen': 1, 'at': int(time.time())}
+                             for key in keys])
+
+    def seen(self, key):
+        return self.seen_many([key])[0]
+
+    def seen_many(self, keys):
+        rows = self.seen_db.view('_all_docs', keys=keys)
+        return [('error' not in row
+                 and not (row.get('value') or {}).get('deleted'))
+                for row in rows]
+
+    def seen_iterator(self, it, key = lambda x: x):
+        return _filter_seen(self, it, key)
+
+    def cursor_iterator(self, it, source, key, seen_key = lambda x: x):
+        return _filter_cursor(self, it, source, key, seen_key)
+
+    def get_cursor(self, source):
+        """get_cursor(str) -> int or None"""
+        cursor = (self.seen_db.get(self.cursors_id) or {}).get(source)
+        return long(cursor) if cursor is not None else None
+
+    def set_cursor(self, source, value):
+        for attempt in range(self.conflict_retries):
+            doc = self.seen_db.get(self.cursors_id) or {'_id': self.cursors_id}
+            doc[source] = str(value)
+            try:
+                self.seen_db.save(doc)
+                return
+            except self.couchdb.ResourceConflict:
+                continue
+
+    def expire_seen(self):
+        """Delete the seen records older than seen_ttl. CouchDB can't
+           expire documents by itself, so this has to be run
+           periodically: ingest runs it once a day, and `markov.py
+           <init_args> expire' runs it by hand (for the bots that
+           don't run under ingest)"""
+        cutoff = time.time() - self.seen_ttl
+        expired = [{'_id': row.id, '_rev': row.doc['_rev'], '_deleted': True}
+                   for row in self.seen_db.view('_all_docs', include_docs=True)
+                   if row.id != self.cursors_id and row.doc.get('at', 0) < cutoff]
+        for chunk in _chunks(expired, 500):
+            self.seen_db.update(chunk)
+        return len(expired)
+
+    def all_followers(self):
+        """all_followers() -> iter((tuple(str), dict(str -> count)))"""
+        for row in self.db.view('_all_docs', include_docs=True):
+            if row.id.startswith('_design/'):
+                continue
+            yield _unhash_toks(row.id.encode('utf-8')), dict((k, int(v))
+                                                             for (k, v)
+                                                             in row.doc.iteritems()
+                                                             if k != '_rev' and k != '_id')
+
+    def cleanup(self, decr, progress = None):
+        raise NotImplementedError
+
+class Memory(object):
+    # Types:
+    # * tokenlist() -> [Token]
+    # * hashedtoken() -> packed array('i') of token IDs
+
+    # Keeps the whole model in this process. Token strings are
+    # interned to integer IDs, and the followers of each chain are
+    # stored as a pair of arrays (follower IDs, sorted, and their
+    # counts) rather than dicts of strings
+    seen_capacity = 100*1000
+    seen_generations = 2
+
+    def __init__(self, init_args = ''):
+        self.ids = {}
+        self.toks = []
+        self.chains = {}
+        # seen keys are kept in the last `seen_generations' sets of
+        # up to `seen_capacity' keys each
+        self.seen_sets = [set()]
+        self.seen_filter = SeenFilter()
+        self.cursors = {}
+
+    def _intern(self, tok):
         try:
-            self.seen_db[key] = {'seen': 1}
-        except:
-            print key
+            return self.ids[tok]
+        except KeyError:
+            self.ids[tok] = tid = len(self.toks)
+            self.toks.append(tok)
+            return tid
+
+    def _hash_ids(self, ids):
+        return array('i', ids).tostring()
+
+    def _hash_tokens(self, tokens):
+        """tokenlist() -> hashedtoken() or None if any of the tokens
+           has never been seen"""
+        try:
+            return self._hash_ids(self.ids[tok.tok] for tok in tokens)
+        except KeyError:
+            return None
+
+    def _incr(self, hpreds, fid, count, replace = False):
+        try:
+            followers, counts = self.chains[hpreds]
+        except KeyError:
+            followers, counts = self.chains[hpreds] = (array('i'), array('l'))
+        i = bisect_left(followers, fid)
+        if i < len(followers) and followers[i] == fid:
+            counts[i] = count if replace else counts[i] + count
+        else:
+            followers.insert(i, fid)
+            counts.insert(i, count)
+
+    def get_followers(self, keys):
+        """get_followers([tokenlist()]) -> dict(Token -> count)"""
+        try:
+            followers, counts = self.chains[self._hash_tokens(keys)]
+        except KeyError:
+            return {}
+        toks = self.toks
+        return dict((Token(toks[f]), c)
+                    for (f, c)
+                    in izip(followers, counts))
+
+    def get_followers_multi(self, keys_list):
+        """get_followers_multi([[tokenlist()]]) -> [dict(Token -> count)]"""
+        return [self.get_followers(keys) for keys in keys_list]
+
+    def incr_follower(self, preds, token):
+        """incr_followers([token()], token())"""
+        hpreds = self._hash_ids(self._intern(tok.tok) for tok in preds)
+        self._incr(hpreds, self._intern(token.tok), 1)
+
+    def incr_followers_bulk(self, deltas):
+        """incr_followers_bulk(dict(tuple(str) -> dict(str -> count)))"""
+        for preds, followers in deltas.iteritems():
+            hpreds = self._hash_ids(self._intern(tok) for tok in preds)
+            for tok, count in followers.iteritems():
+                self._incr(hpreds, self._intern(tok), count)
+
+    def set_followers(self, values):
+        """set_followers(dict(tuple(str) -> dict(str -> count)))"""
+        for preds, followers in values.iteritems():
+            hpreds = self._hash_ids(self._intern(tok) for tok in preds)
+            for tok, count in followers.iteritems():
+                self._incr(hpreds, self._intern(tok), count, replace=True)
+
+    def delete_followers(self, keys):
+        """delete_followers([tuple(str)])"""
+        for preds in keys:
+            try:
+                del self.chains[self._hash_ids(self.ids[tok] for tok in preds)]
+            except KeyError:
+                pass
+
+    def saw(self, key):
+        self.saw_many([key])
+
+    def saw_many(self, keys):
+        for key in keys:
+            if len(self.seen_sets[0]) >= self.seen_capacity:
+                self.seen_sets.insert(0, set())
+                del self.seen_sets[self.seen_generations:]
+            self.seen_sets[0].add(key)
 
     def seen(self, key):
-        return key in self.seen_db
+        return any(key in seen_set for seen_set in self.seen_sets)
+
+    def seen_many(self, keys):
+        return [self.seen(key) for key in keys]
 
     def seen_iterator(self, it, key = lambda x: x):
-        # this filter errs on the side of acking an item before it's
-        # been processed.
-        for x in it:
-            seen_key = key(x)
-            if not self.seen(seen_key):
-                self.saw(seen_key)
-                yield x
+        return _filter_seen(self, it, key)
+
+    def cursor_iterator(self, it, source, key, seen_key = lambda x: x):
+        return _filter_cursor(self, it, source, key, seen_key)
+
+    def get_cursor(self, source):
+        """get_cursor(str) -> int or None"""
+        return self.cursors.get(source)
+
+    def set_cursor(self, source, value):
+        self.cursors[source] = value
+
+    def all_followers(self):
+        """all_followers() -> iter((tuple(str), dict(str -> count)))"""
+        toks = self.toks
+        # a copy of the rows, so that they can be deleted while we go
+        for key, (followers, counts) in self.chains.items():
+            yield (tuple(toks[i] for i in array('i', key)),
+                   dict((toks[f], c) for (f, c) in izip(followers, counts)))
+
+    def cleanup(self, decr, progress = None):
+        all_decrs = 0
+        all_removals = 0
+        all_keys_modified = 0
+        for key, (followers, counts) in self.chains.items():
+            kept_followers = array('i')
+            kept_counts = array('l')
+            for f, count in izip(followers, counts):
+                if count > decr:
+                    kept_followers.append(f)
+                    kept_counts.append(count - decr)
+
+            removals = len(followers) - len(kept_followers)
+            all_decrs += len(kept_followers)
+            all_removals += removals
+
+            if kept_followers:
+                self.chains[key] = (kept_followers, kept_counts)
+            else:
+                del self.chains[key]
+
+            if followers:
+                all_keys_modified += 1
+
+        if progress:
+            progress(len(self.chains), all_decrs, all_removals, all_keys_modified)
+
+        return all_decrs, all_removals, all_keys_modified
+
+class _TrieNode(object):
+    __slots__ = ('children', 'followers', 'counts')
+
+    def __init__(self):
+        # token ID -> _TrieNode, for the token before this one
+        self.children = None
+        self.followers = None
+        self.counts = None
+
+class Trie(Memory):
+    # Types:
+    # * tokenlist() -> [Token]
+
+    # Like Memory, but the chains are stored in a trie of their tokens
+    # in reverse, so that the chains ending in the same tokens share
+    # nodes: (a, b, c) is the child a of the node for (b, c), which is
+    # the child b of the node for (c,). That's also the order that
+    # create_chain asks for them in, so get_followers_multi finds all
+    # of the chain lengths with one walk down from the latest token.
+    # init_args is the path to a file written by save() to load, if
+    # any
+    def __init__(self, init_args = ''):
+        Memory.__init__(self)
+        self.root = _TrieNode()
+        if init_args:
+            self.load(init_args)
+
+    def _node(self, ids, create = False):
+        """The node for the chain of token IDs `ids', or None"""
+        node = self.root
+        for tid in reversed(ids):
+            children = node.children
+            if children is None:
+                if not create:
+                    return None
+                children = node.children = {}
+            try:
+                node = children[tid]
+            except KeyError:
+                if not create:
+                    return None
+                node = children[tid] = _TrieNode()
+        return node
+
+    def _incr(self, node, fid, count, replace = False):
+        if node.followers is None:
+            node.followers, node.counts = array('i'), array('l')
+        followers, counts = node.followers, node.counts
+        i = bisect_left(followers, fid)
+        if i < len(followers) and followers[i] == fid:
+            counts[i] = count if replace else counts[i] + count
+        else:
+            followers.insert(i, fid)
+            counts.insert(i, count)
+
+    def _followers(self, node):
+        if node is None or node.followers is None:
+            return {}
+        toks = self.toks
+        return dict((Token(toks[f]), c)
+                    for (f, c)
+                    in izip(node.followers, node.counts))
+
+    def _ids(self, tokens):
+        """tokenlist() -> [token ID] or None if any of the tokens has
+           never been seen"""
+        try:
+            return [self.ids[tok.tok] for tok in tokens]
+        except KeyError:
+            return None
+
+    def get_followers(self, keys):
+        """get_followers([tokenlist()]) -> dict(Token -> count)"""
+        ids = self._ids(keys)
+        return self._followers(self._node(ids) if ids is not None else None)
+
+    def get_followers_multi(self, keys_list):
+        """get_followers_multi([[tokenlist()]]) -> [dict(Token -> count)]"""
+        if not keys_list:
+            return []
+        # walk the longest chain once, remembering the node at each
+        # depth, which serves every chain that's a suffix of it
+        longest = max(keys_list, key = len)
+        path = [self.root]
+        node = self.root
+        for tok in reversed(longest):
+            tid = self.ids.get(tok.tok)
+            if node.children is None or tid not in node.children:
+                break
+            node = node.children[tid]
+            path.append(node)
+
+        ret = []
+        for keys in keys_list:
+            n = len(keys)
+            # tokens are interned, so identity will do. If the intern
+            # table was emptied in between, it's the slow way
+            if all(a is b for (a, b) in izip(keys, longest[len(longest)-n:])):
+                ret.append(self._followers(path[n]) if n < len(path) else {})
+            else:
+                ret.append(self.get_followers(keys))
+        return ret
+
+    def incr_follower(self, preds, token):
+        """incr_followers([token()], token())"""
+        node = self._node([self._intern(tok.tok) for tok in preds], create=True)
+        self._incr(node, self._intern(token.tok), 1)
+
+    def incr_followers_bulk(self, deltas):
+        """incr_followers_bulk(dict(tuple(str) -> dict(str -> count)))"""
+        for preds, followers in deltas.iteritems():
+            node = self._node([self._intern(tok) for tok in preds], create=True)
+            for tok, count in followers.iteritems():
+                self._incr(node, self._intern(tok), count)
+
+    def set_followers(self, values):
+        """set_followers(dict(tuple(str) -> dict(str -> count)))"""
+        for preds, followers in values.iteritems():
+            node = self._node([self._intern(tok) for tok in preds], create=True)
+            for tok, count in followers.iteritems():
+                self._incr(node, self._intern(tok), count, replace=True)
+
+    def delete_followers(self, keys):
+        """delete_followers([tuple(str)])"""
+        for preds in keys:
+            try:
+                node = self._node([self.ids[tok] for tok in preds])
+            except KeyError:
+                continue
+            if node is not None:
+                node.followers = node.counts = None
+
+    def _walk(self, node, ids):
+        """Yield (token IDs, node) for `node', the node for the chain
+           `ids' (most recent token first), and everything below it"""
+        yield ids, node
+        if node.children:
+            for tid, child in node.children.items():
+                for x in self._walk(child, ids + (tid,)):
+                    yield x
+
+    def all_followers(self):
+        """all_followers() -> iter((tuple(str), dict(str -> count)))"""
+        toks = self.toks
+        for ids, node in self._walk(self.root, ()):
+            if node.followers:
+                yield (tuple(toks[i] for i in reversed(ids)),
+                       dict((toks[f], c) for (f, c) in izip(node.followers, node.counts)))
+
+    def _prune(self, node):
+        """Drop the children of `node' with no chains under them, and
+           return whether `node' is itself empty"""
+        if node.children:
+            for tid, child in node.children.items():
+                if self._prune(child):
+                    del node.children[tid]
+        if not node.children:
+            node.children = None
+        return node.children is None and not node.followers
+
+    def cleanup(self, decr, progress = None):
+        all_decrs = 0
+        all_removals = 0
+        all_keys_modified = 0
+        rows = 0
+        for ids, node in list(self._walk(self.root, ())):
+            if not node.followers:
+                continue
+            kept_followers = array('i')
+            kept_counts = array('l')
+            for f, count in izip(node.followers, node.counts):
+                if count > decr:
+                    kept_followers.append(f)
+                    kept_counts.append(count - decr)
+
+            all_decrs += len(kept_followers)
+            all_removals += len(node.followers) - len(kept_followers)
+            all_keys_modified += 1
+            rows += 1
+
+            if kept_followers:
+                node.followers, node.counts = kept_followers, kept_counts
+            else:
+                node.followers = node.counts = None
+        self._prune(self.root)
+
+        if progress:
+            progress(rows, all_decrs, all_removals, all_keys_modified)
+
+        return all_decrs, all_removals, all_keys_modified
+
+    # the file written by save is a pickle of
+    #
+    #   (version, [token string], node)
+    #
+    # where a node is (followers.tostring(), counts.tostring(),
+    # [(token ID, node)])
+    file_version = 1
+
+    def _dump(self, node):
+        return (node.followers.tostring() if node.followers else '',
+                node.counts.tostring() if node.counts else '',
+                [(tid, self._dump(child))
+                 for (tid, child) in (node.children or {}).iteritems()])
+
+    def _undump(self, dumped):
+        followers, counts, children = dumped
+        node = _TrieNode()
+        if followers:
+            node.followers = array('i', followers)
+            node.counts = array('l', counts)
+        if children:
+            node.children = dict((tid, self._undump(child))
+                                 for (tid, child) in children)
+        return node
+
+    def save(self, path):
+        """Write the chains to `path', replacing it atomically"""
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            cPickle.dump((self.file_version, self.toks, self._dump(self.root)),
+                         f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, path)
+
+    def load(self, path):
+        """Replace the chains with the ones saved to `path'"""
+        with open(path, 'rb') as f:
+            version, toks, root = cPickle.load(f)
+        if version != self.file_version:
+            raise ValueError("%s is a version %d trie, not %d"
+                             % (path, version, self.file_version))
+        self.toks = toks
+        self.ids = dict((tok, i) for (i, tok) in enumerate(toks))
+        self.root = self._undump(root)
+
+class Cached(object):
+    # Wraps any of the other backends, remembering the results of
+    # get_followers in a size-bounded LRU with an optional TTL (in
+    # seconds). Increments made through the wrapper invalidate the
+    # chains that they touch; increments made by anyone else are only
+    # noticed when the entry expires. Everything else is passed
+    # through to the wrapped backend
+    def __init__(self, backend, size = 10*1000, ttl = None):
+        self.backend = backend
+        self.size = size
+        self.ttl = ttl
+        # tuple(str) -> (expiry time or None, dict(Token -> count))
+        self.lru = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def _key(self, tokens):
+        return tuple(tok.tok for tok in tokens)
+
+    def _lookup(self, key):
+        try:
+            expires, followers = self.lru.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        if expires is not None and expires < time.time():
+            self.misses += 1
+            return None
+        # re-inserting moves it to the most-recently-used end
+        self.lru[key] = (expires, followers)
+        self.hits += 1
+        return followers
+
+    def _store(self, key, followers):
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        self.lru[key] = (expires, followers)
+        while len(self.lru) > self.size:
+            self.lru.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        return dict(hits = self.hits,
+                    misses = self.misses,
+                    evictions = self.evictions,
+                    size = len(self.lru))
+
+    def get_followers(self, keys):
+        """get_followers([tokenlist()]) -> dict(Token -> count)"""
+        # note that the same dict is handed out to every caller, so
+        # callers mustn't modify it
+        key = self._key(keys)
+        followers = self._lookup(key)
+        if followers is None:
+            followers = self.backend.get_followers(keys)
+            self._store(key, followers)
+        return followers
+
+    def get_followers_multi(self, keys_list):
+        """get_followers_multi([[tokenlist()]]) -> [dict(Token -> count)]"""
+        ret = [self._lookup(self._key(keys)) for keys in keys_list]
+        missing = [i for (i, followers) in enumerate(ret) if followers is None]
+        if missing:
+            fetched = self.backend.get_followers_multi([keys_list[i] for i in missing])
+            for i, followers in zip(missing, fetched):
+                self._store(self._key(keys_list[i]), followers)
+                ret[i] = followers
+        return ret
+
+    def incr_follower(self, preds, token):
+        """incr_followers([token()], token())"""
+        self.backend.incr_follower(preds, token)
+        self.lru.pop(self._key(preds), None)
+
+    def incr_followers_bulk(self, deltas):
+        """incr_followers_bulk(dict(tuple(str) -> dict(str -> count)))"""
+        self.backend.incr_followers_bulk(deltas)
+        for preds in deltas:
+            self.lru.pop(preds, None)
+
+    def set_followers(self, values):
+        """set_followers(dict(tuple(str) -> dict(str -> count)))"""
+        self.backend.set_followers(values)
+        for preds in values:
+            self.lru.pop(preds, None)
+
+    def delete_followers(self, keys):
+        """delete_followers([tuple(str)])"""
+        self.backend.delete_followers(keys)
+        for preds in keys:
+            self.lru.pop(preds, None)
+
+    def cleanup(self, decr, progress = None):
+        ret = self.backend.cleanup(decr, progress)
+        self.lru.clear()
+        return ret
+
+def _instrumented(method):
+    def _fn(self, *a, **kw):
+        name = '%s.%s' % (self.prefix, method)
+        metrics.incr(name)
+        with metrics.timer(name):
+            return getattr(self.backend, method)(*a, **kw)
+    _fn.__name__ = method
+    return _fn
+
+class Instrumented(object):
+    # Wraps any of the other backends (including Cached), counting and
+    # timing the calls made through it under `prefix'.method in the
+    # metrics sink. Everything else is passed through to the wrapped
+    # backend
+    def __init__(self, backend, prefix = 'backend'):
+        self.backend = backend
+        self.prefix = prefix
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    get_followers = _instrumented('get_followers')
+    get_followers_multi = _instrumented('get_followers_multi')
+    incr_follower = _instrumented('incr_follower')
+    incr_followers_bulk = _instrumented('incr_followers_bulk')
+    set_followers = _instrumented('set_followers')
+    delete_followers = _instrumented('delete_followers')
+    saw = _instrumented('saw')
+    saw_many = _instrumented('saw_many')
+    seen = _instrumented('seen')
+    seen_many = _instrumented('seen_many')
+    cleanup = _instrumented('cleanup')
+
+    # so that the lookups they make go through the wrapper
+    def seen_iterator(self, it, key = lambda x: x):
+        return _filter_seen(self, it, key)
+
+    def cursor_iterator(self, it, source, key, seen_key = lambda x: x):
+        return _filter_cursor(self, it, source, key, seen_key)
+
+# the column that Decaying keeps each chain's last decayed period in.
+# Tokens never contain NULs, so it can't be a real follower
+_decayed_column = '\x00decayed'
+_decayed_token = Token(_decayed_column)
+
+def _tokens(preds):
+    """tuple(str) -> tokenlist()"""
+    return [BeginToken() if tok == BeginToken.tok
+            else EndToken() if tok == EndToken.tok
+            else Token(tok)
+            for tok in preds]
+
+class Decaying(object):
+    # Wraps any of the writable backends, decaying the follower counts
+    # as time passes, one `period' (in seconds) at a time: each period
+    # multiplies them by `factor' (exponential decay) or, if that
+    # isn't given, subtracts `decr' from them (step decay, like
+    # cleanup). Rather than rewriting the whole table every so often,
+    # each chain remembers the last period it was decayed for, and is
+    # brought up to date when it's next read or incremented; sweep()
+    # catches up the chains that nobody touches. The period is set
+    # with set_followers and the decay is written as increments, so
+    # increments made in the meantime aren't lost. That's not atomic,
+    # though: if two processes (say, a writer and the sweeper) catch
+    # up the same chain at the same moment, both decrements land and
+    # the chain is decayed twice for the periods it was behind by. The
+    # backend has to support set_followers, so Cassandra counter column
+    # families are refused. Once decay is on, the store must only be
+    # read through this wrapper, since the chains carry an extra
+    # column
+    def __init__(self, backend, period = 24*60*60, factor = None, decr = 1):
+        if getattr(backend, 'counters', False):
+            raise ValueError("Decay can't be used with a counter column family,"
+                             " which can't store the period chains were decayed for")
+        self.backend = backend
+        self.period = period
+        self.factor = factor
+        self.decr = decr
+        self.sweeper = None
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def _now(self):
+        return int(time.time() // self.period)
+
+    def _decayed(self, count, elapsed):
+        if self.factor is not None:
+            # rounded up with the probability of the fraction, so
+            # that it's count * factor ** elapsed on average. Always
+            # rounding down would take at least 1 off every count
+            # every period, however close to 1 the factor is
+            exact = count * self.factor ** elapsed
+            new = int(exact)
+            if random.random() < exact - new:
+                new += 1
+            return new
+        return count - self.decr * elapsed
+
+    def _decay(self, row, now):
+        """Bring the dict(str -> count) `row' up to period `now' ->
+           (decayed dict(str -> count),
+            dict(str -> delta) to write, or None if it's up to date)"""
+        epoch = row.get(_decayed_column)
+        followers = dict((tok, count)
+                         for (tok, count) in row.iteritems()
+                         if count > 0 and tok != _decayed_column)
+        if epoch == now or (epoch is None and not followers):
+            return followers, None
+        if epoch is None or epoch > now:
+            # new, from before decay was turned on, or stamped in the
+            # future by a skewed clock, so its clock starts now
+            return followers, {}
+
+        elapsed = now - epoch
+        decayed = {}
+        deltas = {}
+        for tok, count in followers.iteritems():
+            new = self._decayed(count, elapsed)
+            if new > 0:
+                decayed[tok] = new
+                deltas[tok] = new - count
+            else:
+                # this leaves a 0, since there's no way to remove a
+                # single column. They go when the chain does
+                deltas[tok] = -count
+        return decayed, deltas
+
+    def _write(self, now, stale, updates, dead):
+        """Mark the `stale' chains as decayed up to `now', then apply
+           the `updates' increments and delete the `dead' chains.
+           Setting the period first means that if we fail part way
+           the chains are decayed too little rather than twice"""
+        if stale:
+            self.backend.set_followers(dict((preds, {_decayed_column: now})
+                                            for preds in stale))
+        if updates:
+            self.backend.incr_followers_bulk(updates)
+        if dead:
+            self.backend.delete_followers(dead)
+
+    def get_followers(self, keys):
+        """get_followers([tokenlist()]) -> dict(Token -> count)"""
+        return self.get_followers_multi([keys])[0]
+
+    def get_followers_multi(self, keys_list):
+        """get_followers_multi([[tokenlist()]]) -> [dict(Token -> count)]"""
+        now = self._now()
+        ret = []
+        stale = []
+        updates = {}
+        dead = []
+        for keys, row in zip(keys_list, self.backend.get_followers_multi(keys_list)):
+            tokens = dict((tok.tok, tok) for tok in row)
+            decayed, deltas = self._decay(dict((tok.tok, count)
+                                               for (tok, count) in row.iteritems()),
+                                          now)
+            ret.append(dict((tokens[tok], count) for (tok, count) in decayed.iteritems()))
+            if deltas is None:
+                continue
+            preds = tuple(tok.tok for tok in keys)
+            if decayed:
+                stale.append(preds)
+                if deltas:
+                    updates[preds] = deltas
+            else:
+                dead.append(preds)
+        self._write(now, stale, updates, dead)
+        return ret
+
+    def incr_follower(self, preds, token):
+        """incr_followers([token()], token())"""
+        self.incr_followers_bulk({tuple(tok.tok for tok in preds): {token.tok: 1}})
+
+    def incr_followers_bulk(self, deltas):
+        """incr_followers_bulk(dict(tuple(str) -> dict(str -> count)))"""
+        # the chains have to be decayed before they're incremented, or
+        # the new counts would be decayed for the time before they
+        # were made. The decay goes out with the increments
+        now = self._now()
+        keys = list(deltas)
+        rows = self.backend.get_followers_multi([_tokens(preds) for preds in keys])
+        stale = []
+        updates = {}
+        for preds, row in zip(keys, rows):
+            decayed, decay = self._decay(dict((tok.tok, count)
+                                              for (tok, count) in row.iteritems()),
+                                         now)
+            if row.get(_decayed_token) != now:
+                stale.append(preds)
+            followers = updates[preds] = decay or {}
+            for tok, count in deltas[preds].iteritems():
+                followers[tok] = followers.get(tok, 0) + count
+        self._write(now, stale, updates, [])
+
+    def delete_followers(self, keys):
+        """delete_followers([tuple(str)])"""
+        self.backend.delete_followers(keys)
+
+    def all_followers(self):
+        """all_followers() -> iter((tuple(str), dict(str -> count)))"""
+        # as they would be if they were decayed now
+        now = self._now()
+        for preds, row in self.backend.all_followers():
+            decayed, deltas = self._decay(row, now)
+            if decayed:
+                yield preds, decayed
+
+    def sweep(self, stale = 1, batch_size = 500, pause = 1.0, progress = None):
+        """Decay the chains that haven't been decayed for at least
+           `stale' periods, writing `batch_size' of them at a time and
+           pausing for `pause' seconds between batches so as to not
+           load the store. Returns (rows scanned, rows decayed, rows
+           removed)"""
+        now = self._now()
+        all_rows = all_decayed = all_removed = 0
+        for rows in _ichunks(self.backend.all_followers(), batch_size):
+            caught_up = []
+            updates = {}
+            dead = []
+            for preds, row in rows:
+                epoch = row.get(_decayed_column)
+                if epoch is not None and 0 <= now - epoch < stale:
+                    continue
+                decayed, deltas = self._decay(row, now)
+                if deltas is None:
+                    continue
+                elif decayed:
+                    caught_up.append(preds)
+                    if deltas:
+                        updates[preds] = deltas
+                else:
+                    dead.append(preds)
+            self._write(now, caught_up, updates, dead)
+
+            all_rows += len(rows)
+            all_decayed += len(caught_up)
+            all_removed += len(dead)
+            if progress:
+                progress(all_rows, all_decayed, all_removed)
+            if caught_up or dead:
+                time.sleep(pause)
+        return all_rows, all_decayed, all_removed
+
+    def start_sweeper(self, **kw):
+        """Sweep in a background thread once a period"""
+        def sweeper():
+            while True:
+                try:
+                    self.sweep(**kw)
+                except Exception:
+                    traceback.print_exc()
+                time.sleep(self.period)
+        self.sweeper = threading.Thread(target=sweeper, name='sweeper')
+        self.sweeper.daemon = True
+        self.sweeper.start()
+
+    def cleanup(self, decr, progress = None):
+        # cleanup would decrement the decayed column too
+        raise NotImplementedError("Decaying stores are kept clean by sweep()")
+
+def decaying_from_env(backend):
+    """Wrap `backend' in Decaying if REDDITRON_DECAY is set to its
+       options, e.g. "period=86400,factor=0.9" or "decr=1" (or just
+       "on" for the defaults). Read-only backends like Compiled are
+       returned as they are: their counts were decayed when they were
+       written, and Decaying can't write the decay back to them. Raises
+       ValueError for Cassandra counter column families, which it
+       can't be used with"""
+    spec = os.environ.get('REDDITRON_DECAY')
+    if not spec or getattr(backend, 'read_only', False):
+        return backend
+    args, options = _parse_init_args(spec)
+    kw = {}
+    if 'period' in options:
+        kw['period'] = float(options['period'])
+    if 'factor' in options:
+        kw['factor'] = float(options['factor'])
+    if 'decr' in options:
+        kw['decr'] = int(options['decr'])
+    return Decaying(backend, **kw)
+
+def _ring_point(s):
+    return struct.unpack('<Q', hashlib.md5(s).digest()[:8])[0]
+
+class Sharded(object):
+    # Types:
+    # * tokenlist() -> [Token]
+    # * hashedtoken()
+
+    # Spreads the chains over several backends (shards), placing each
+    # chain with a consistent hash of its hashedtoken() so that adding
+    # a shard only moves the chains that now belong to it. init_args
+    # is a |-separated list of Backend:init_args, e.g.
+    #
+    #   Redis:host1,6379,0|Redis:host2,6379,0
+    #
+    # or a list of (name, backend) pairs. A shard's position on the
+    # ring comes from its name (the spec string, for init_args), so
+    # the names have to stay the same between runs. The calls for
+    # several chains are split up by shard and sent to the shards in
+    # parallel. The seen keys and cursors are small, so they're all
+    # kept on the first shard
+    vnodes = 100
+
+    def __init__(self, init_args):
+        if isinstance(init_args, basestring):
+            init_args = [(spec, _backend_from_spec(spec))
+                         for spec in init_args.split('|')]
+        self.shards = []
+        self.ring = []
+        for name, backend in init_args:
+            self._add_to_ring(name, backend)
+        # the ring from before add_shard, while rebalance hasn't
+        # finished moving the chains off of it
+        self.old_ring = None
+        # the thread pool for _fan_out, and the number of calls using
+        # each pool, so that add_shard's replacement doesn't close one
+        # from under them
+        self.pool = None
+        self.pool_calls = {}
+        self.pool_lock = threading.Lock()
+        self.seen_filter = SeenFilter()
+
+    @property
+    def counters(self):
+        """Whether any of the shards can only be incremented"""
+        return any(getattr(shard, 'counters', False)
+                   for (name, shard) in self.shards)
+
+    def _add_to_ring(self, name, backend):
+        self.shards.append((name, backend))
+        self.ring = sorted(self.ring + [(_ring_point('%s#%d' % (name, i)), backend)
+                                        for i in range(self.vnodes)])
+
+    def _owner(self, ring, hkey):
+        i = bisect_left(ring, (_ring_point(hkey),))
+        return ring[i % len(ring)][1]
+
+    def _owners(self, hkey):
+        """The shard that `hkey' belongs on, and the one that it used to
+           be on if a rebalance is in progress and that's different"""
+        owner = self._owner(self.ring, hkey)
+        if self.old_ring is not None:
+            old_owner = self._owner(self.old_ring, hkey)
+            if old_owner is not owner:
+                return [owner, old_owner]
+        return [owner]
+
+    def _fan_out(self, calls):
+        """Run the (fn, args) pairs in `calls' in parallel, returning
+           their results in order"""
+        if not calls:
+            return []
+        if len(calls) == 1:
+            fn, args = calls[0]
+            return [fn(*args)]
+        with self.pool_lock:
+            if self.pool is None:
+                from multiprocessing.pool import ThreadPool
+                self.pool = ThreadPool(len(self.shards))
+            pool = self.pool
+            self.pool_calls[pool] = self.pool_calls.get(pool, 0) + 1
+        try:
+            return pool.map(lambda (fn, args): fn(*args), calls)
+        finally:
+            with self.pool_lock:
+                self.pool_calls[pool] -= 1
+                if not self.pool_calls[pool]:
+                    del self.pool_calls[pool]
+                    if pool is not self.pool:
+                        # replaced by add_shard while we were using it
+                        pool.close()
+
+    def _hash_tokens(self, tokens):
+        """tokenlist() -> hashedtoken()"""
+        return ' '.join(tok.tok.encode('utf-8') for tok in tokens)
+
+    def get_followers(self, keys):
+        """get_followers([tokenlist()]) -> dict(Token -> count)"""
+        return self.get_followers_multi([keys])[0]
+
+    def get_followers_multi(self, keys_list):
+        """get_followers_multi([[tokenlist()]]) -> [dict(Token -> count)]"""
+        # shard -> [index into keys_list]
+        by_shard = OrderedDict()
+        for i, keys in enumerate(keys_list):
+            for shard in self._owners(self._hash_tokens(keys)):
+                by_shard.setdefault(shard, []).append(i)
+
+        results = self._fan_out([(shard.get_followers_multi,
+                                  ([keys_list[i] for i in indexes],))
+                                 for (shard, indexes) in by_shard.iteritems()])
+
+        ret = [{} for keys in keys_list]
+        for indexes, fetched in zip(by_shard.itervalues(), results):
+            for i, followers in zip(indexes, fetched):
+                # a chain is only found on two shards while it's being
+                # moved, so this is nearly always the first
+                if not ret[i]:
+                    ret[i] = followers
+                else:
+                    ret[i] = dict(ret[i])
+                    for tok, count in followers.iteritems():
+                        ret[i][tok] = ret[i].get(tok, 0) + count
+        return ret
+
+    def incr_follower(self, preds, token):
+        """incr_followers([token()], token())"""
+        self._owner(self.ring, self._hash_tokens(preds)).incr_follower(preds, token)
+
+    def _split(self, ring, deltas):
+        """dict(tuple(str) -> x) -> OrderedDict(shard -> dict(tuple(str) -> x))"""
+        by_shard = OrderedDict()
+        for preds, followers in deltas.iteritems():
+            shard = self._owner(ring, _hash_toks(preds))
+            by_shard.setdefault(shard, {})[preds] = followers
+        return by_shard
+
+    def incr_followers_bulk(self, deltas):
+        """incr_followers_bulk(dict(tuple(str) -> dict(str -> count)))"""
+        self._fan_out([(shard.incr_followers_bulk, (shard_deltas,))
+                       for (shard, shard_deltas)
+                       in self._split(self.ring, deltas).iteritems()])
+
+    def set_followers(self, values):
+        """set_followers(dict(tuple(str) -> dict(str -> count)))"""
+        self._fan_out([(shard.set_followers, (shard_values,))
+                       for (shard, shard_values)
+                       in self._split(self.ring, values).iteritems()])
+
+    def delete_followers(self, keys):
+        """delete_followers([tuple(str)])"""
+        keys = dict((preds, None) for preds in keys)
+        rings = [self.ring] + ([self.old_ring] if self.old_ring is not None else [])
+        by_shard = {}
+        for ring in rings:
+            for shard, shard_keys in self._split(ring, keys).iteritems():
+                by_shard.setdefault(shard, set()).update(shard_keys)
+        self._fan_out([(shard.delete_followers, (list(shard_keys),))
+                       for (shard, shard_keys) in by_shard.iteritems()])
+
+    def add_shard(self, name, backend):
+        """Add a shard to the ring. New increments for the chains that
+           now belong to it go to it straight away, and reads look on
+           both it and the shard that they used to belong to until
+           `rebalance' has moved them over"""
+        if self.old_ring is None:
+            self.old_ring = self.ring
+        self._add_to_ring(name, backend)
+        # the pool is sized for the shards, so the next _fan_out makes
+        # a new one. The old one is closed by the last call using it
+        with self.pool_lock:
+            old, self.pool = self.pool, None
+            if old is not None and old not in self.pool_calls:
+                old.close()
+
+    def rebalance(self, batch_size = 500, progress = None):
+        """Move the chains that aren't on the shard that they belong on
+           any more, `batch_size' at a time. This can run alongside
+           the bots, but other processes using the same shards need
+           their rings updated first, or they'll keep writing to the
+           old places. Returns the number of chains moved"""
+        moved = 0
+        for name, shard in self.shards:
+            misplaced = ((preds, followers)
+                         for (preds, followers) in shard.all_followers()
+                         if self._owner(self.ring, _hash_toks(preds)) is not shard)
+            for rows in _ichunks(misplaced, batch_size):
+                # copy them before deleting them, so that they're
+                # always somewhere that reads look
+                self.incr_followers_bulk(dict(rows))
+                shard.delete_followers([preds for (preds, followers) in rows])
+                moved += len(rows)
+                if progress:
+                    progress(name, moved)
+        self.old_ring = None
+        return moved
+
+    def saw(self, key):
+        self.saw_many([key])
+
+    def saw_many(self, keys):
+        self.shards[0][1].saw_many(keys)
+
+    def seen(self, key):
+        return self.seen_many([key])[0]
+
+    def seen_many(self, keys):
+        return self.shards[0][1].seen_many(keys)
+
+    def seen_iterator(self, it, key = lambda x: x):
+        return _filter_seen(self, it, key)
+
+    def cursor_iterator(self, it, source, key, seen_key = lambda x: x):
+        return _filter_cursor(self, it, source, key, seen_key)
+
+    def get_cursor(self, source):
+        """get_cursor(str) -> int or None"""
+        return self.shards[0][1].get_cursor(source)
+
+    def set_cursor(self, source, value):
+        self.shards[0][1].set_cursor(source, value)
+
+    def all_followers(self):
+        """all_followers() -> iter((tuple(str), dict(str -> count)))"""
+        # a chain that's being moved by a rebalance can be yielded
+        # twice, once from each shard
+        for name, shard in self.shards:
+            for row in shard.all_followers():
+                yield row
+
+    def cleanup(self, decr, progress = None):
+        # each shard's progress is reported as the total of the latest
+        # progress from all of them
+        latest = [(0, 0, 0, 0)] * len(self.shards)
+        def shard_progress(i):
+            def _progress(*counts):
+                latest[i] = counts
+                if progress:
+                    progress(*[sum(c) for c in zip(*latest)])
+            return _progress
+
+        results = self._fan_out([(shard.cleanup, (decr, shard_progress(i)))
+                                 for (i, (name, shard)) in enumerate(self.shards)])
+        return tuple(sum(counts) for counts in zip(*results))
+
+def _backend_from_spec(spec):
+    """'Backend:init_args' -> Backend(init_args)"""
+    backend, init_args = spec.split(':', 1)
+    return globals()[backend](init_args)
+
+# Compiled model files are laid out as (all integers are little-endian
+# uint32s):
+#
+#   magic, version, ntoks, nkeys, nfollowers
+#   token offsets [ntoks+1], token strings
+#   key offsets [nkeys+1], hashedtoken() keys in sorted order
+#   row offsets [nkeys+1] into the follower entries
+#   follower entries [nfollowers] of (token index, count)
+#
+# so a reader can binary search the keys and decode a row without
+# loading anything but the pages it touches. Version 2 files are the
+# same but for follower entries of (uint32 token index, uint8 count),
+# for models whose counts have been quantized to fit in a byte
+compiled_magic = 'RDTRNMDL'
+compiled_version = 1
+compiled_narrow_version = 2
+_compiled_header = struct.Struct('<8sIIII')
+_uint = struct.Struct('<I')
+_follower = struct.Struct('<II')
+_narrow_follower = struct.Struct('<IB')
+_followers_by_version = {compiled_version: _follower,
+                         compiled_narrow_version: _narrow_follower}
+
+def compile_model(cache, path):
+    """Snapshot the follower table of any backend into a compiled
+       model file at `path' that can be served by `Compiled'"""
+    return _write_compiled(path, cache.all_followers())
+
+def _write_compiled(path, all_followers, version = compiled_version):
+    """Write the (tuple(str), dict(str -> count)) rows yielded by
+       `all_followers' to a compiled model file"""
+    follower = _followers_by_version[version]
+    rows = sorted((_hash_toks(preds), followers)
+                  for (preds, followers)
+                  in all_followers
+                  if followers)
+    toks = sorted(set(tok.encode('utf-8')
+                      for (hkey, followers) in rows
+                      for tok in followers))
+    tok_ids = dict((tok, i) for (i, tok) in enumerate(toks))
+    nfollowers = sum(len(followers) for (hkey, followers) in rows)
+
+    def offsets(lengths):
+        offs = array('I', [0])
+        for l in lengths:
+            offs.append(offs[-1] + l)
+        return offs
+
+    with open(path, 'wb') as f:
+        f.write(_compiled_header.pack(compiled_magic, version,
+                                      len(toks), len(rows), nfollowers))
+        f.write(struct.pack('<%dI' % (len(toks)+1),
+                            *offsets(len(tok) for tok in toks)))
+        f.write(''.join(toks))
+        f.write(struct.pack('<%dI' % (len(rows)+1),
+                            *offsets(len(hkey) for (hkey, followers) in rows)))
+        f.write(''.join(hkey for (hkey, followers) in rows))
+        f.write(struct.pack('<%dI' % (len(rows)+1),
+                            *offsets(len(followers) for (hkey, followers) in rows)))
+        for hkey, followers in rows:
+            for tok, count in sorted(followers.iteritems()):
+                f.write(follower.pack(tok_ids[tok.encode('utf-8')], count))
+
+    return len(rows), nfollowers
+
+def _prune_followers(followers, top_k, min_count, levels):
+    """Apply export_model's pruning and quantization to one row"""
+    kept = [(tok, count)
+            for (tok, count) in followers.iteritems()
+            if count >= min_count]
+    if top_k is not None and len(kept) > top_k:
+        kept = heapq.nlargest(top_k, kept, key = lambda (tok, count): (count, tok))
+    if levels is not None and kept:
+        # scale the counts so that the largest is `levels', which
+        # keeps their proportions as well as small integers can
+        top = max(count for (tok, count) in kept)
+        if top > levels:
+            kept = [(tok, max(1, int(round(count * levels / float(top)))))
+                    for (tok, count) in kept]
+    return dict(kept)
+
+def _total_variation(before, after):
+    """The total variation distance between the follower
+       distributions given by two dict(str -> count)s"""
+    before_total = float(sum(before.itervalues()))
+    after_total = float(sum(after.itervalues()))
+    if not before_total or not after_total:
+        return 1.0 if before_total != after_total else 0.0
+    return 0.5 * sum(abs(before.get(tok, 0) / before_total
+                         - after.get(tok, 0) / after_total)
+                     for tok in set(before) | set(after))
+
+def export_model(cache, path, top_k = None, min_count = 1, levels = None):
+    """Write a compiled model file for serving from any backend,
+       keeping only the `top_k' most frequent followers of each chain
+       whose counts are at least `min_count', and scaling each chain's
+       counts to at most `levels' (up to 255 of which are stored in
+       one byte). Returns a dict describing the size reduction and how
+       far the distributions that create_chain samples from moved:
+       the total variation distance of each chain's followers (1.0 for
+       chains dropped altogether), averaged weighted by how often the
+       chain was seen, and its maximum"""
+    stats = dict(rows = 0, followers = 0, bytes = 0,
+                 exported_rows = 0, exported_followers = 0,
+                 mean_tvd = 0.0, max_tvd = 0.0)
+    toks = set()
+    weighted_tvd = 0.0
+    total_count = 0
+    exported = []
+    for preds, followers in cache.all_followers():
+        if not followers:
+            continue
+        pruned = _prune_followers(followers, top_k, min_count, levels)
+        tvd = _total_variation(followers, pruned)
+        count = sum(followers.itervalues())
+        weighted_tvd += tvd * count
+        total_count += count
+        stats['max_tvd'] = max(stats['max_tvd'], tvd)
+
+        stats['rows'] += 1
+        stats['followers'] += len(followers)
+        stats['bytes'] += len(_hash_toks(preds))
+        toks.update(tok.encode('utf-8') for tok in followers)
+        if pruned:
+            exported.append((preds, pruned))
+
+    # what compile_model would have written
+    stats['bytes'] += (_compiled_header.size
+                       + _uint.size * (len(toks) + 1 + 2 * (stats['rows'] + 1))
+                       + sum(len(tok) for tok in toks)
+                       + _follower.size * stats['followers'])
+    if total_count:
+        stats['mean_tvd'] = weighted_tvd / total_count
+
+    narrow = levels is not None and levels <= 255
+    stats['exported_rows'], stats['exported_followers'] = \
+        _write_compiled(path, exported,
+                        compiled_narrow_version if narrow else compiled_version)
+    stats['exported_bytes'] = os.path.getsize(path)
+    return stats
+
+class Compiled(object):
+    # Types:
+    # * tokenlist() -> [Token]
+    # * hashedtoken()
+
+    # A read-only backend serving get_followers from an mmap of a file
+    # written by compile_model. Processes mapping the same file share
+    # its pages through the page cache
+    read_only = True
+
+    def __init__(self, init_args):
+        path = init_args
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, version, self.ntoks, self.nkeys,
+         self.nfollowers) = _compiled_header.unpack_from(self.mm, 0)
+        if magic != compiled_magic or version not in _followers_by_version:
+            raise ValueError('%r is not a compiled model' % (path,))
+        self.follower = _followers_by_version[version]
+
+        self.tok_offsets = _compiled_header.size
+        self.tok_data = self.tok_offsets + (self.ntoks+1) * _uint.size
+        self.key_offsets = self.tok_data + self._offset(self.tok_offsets, self.ntoks)
+        self.key_data = self.key_offsets + (self.nkeys+1) * _uint.size
+        self.row_offsets = self.key_data + self._offset(self.key_offsets, self.nkeys)
+        self.follower_data = self.row_offsets + (self.nkeys+1) * _uint.size
+
+        # decoded Tokens, by token index
+        self.tokens = {}
+
+    def _offset(self, base, i):
+        return _uint.unpack_from(self.mm, base + i * _uint.size)[0]
+
+    def _key(self, i):
+        start = self._offset(self.key_offsets, i)
+        end = self._offset(self.key_offsets, i+1)
+        return self.mm[self.key_data+start:self.key_data+end]
+
+    def _tok(self, i):
+        start = self._offset(self.tok_offsets, i)
+        end = self._offset(self.tok_offsets, i+1)
+        return self.mm[self.tok_data+start:self.tok_data+end]
+
+    def _token(self, i):
+        try:
+            return self.tokens[i]
+        except KeyError:
+            self.tokens[i] = tok = Token(self._tok(i))
+            return tok
+
+    def _find(self, hkey):
+        """hashedtoken() -> row index or None"""
+        lo, hi = 0, self.nkeys
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < hkey:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.nkeys and self._key(lo) == hkey:
+            return lo
+
+    def _row(self, i):
+        """row index -> iter((token index, count))"""
+        start = self._offset(self.row_offsets, i)
+        end = self._offset(self.row_offsets, i+1)
+        follower = self.follower
+        for n in xrange(start, end):
+            yield follower.unpack_from(self.mm, self.follower_data + n * follower.size)
+
+    def _hash_tokens(self, tokens):
+        """tokenlist() -> hashedtoken()"""
+        return ' '.join(tok.tok.encode('utf-8') for tok in tokens)
+
+    def get_followers(self, keys):
+        """get_followers([tokenlist()]) -> dict(Token -> count)"""
+        i = self._find(self._hash_tokens(keys))
+        if i is None:
+            return {}
+        return dict((self._token(t), count)
+                    for (t, count)
+                    in self._row(i))
+
+    def get_followers_multi(self, keys_list):
+        """get_followers_multi([[tokenlist()]]) -> [dict(Token -> count)]"""
+        return [self.get_followers(keys) for keys in keys_list]
+
+    def all_followers(self):
+        """all_followers() -> iter((tuple(str), dict(str -> count)))"""
+        for i in xrange(self.nkeys):
+            yield _unhash_toks(self._key(i)), dict((self._tok(t), count)
+                                                   for (t, count)
+                                                   in self._row(i))
+
+    def incr_follower(self, preds, token):
+        raise NotImplementedError
+
+    def incr_followers_bulk(self, deltas):
+        raise NotImplementedError
+
+    def set_followers(self, values):
+        raise NotImplementedError
+
+    def delete_followers(self, keys):
+        raise NotImplementedError
+
+    def seen_iterator(self, it, key = lambda x: x):
+        raise NotImplementedError
+
+    def cursor_iterator(self, it, source, key, seen_key = lambda x: x):
+        raise NotImplementedError
 
-    def cleanup(self, decr):
+    def cleanup(self, decr, progress = None):
         raise NotImplementedError
@@ -6,8 +6,10 @@ import random
 import sys
 import twitter
 import urllib2
+import metrics
 from markov import save_chains, create_sentences
-from backends import Redis as Cache
+from ingest import published_key
+from backends import Redis as Cache, Instrumented, decaying_from_env
 
 urls = ['http://newsrss.bbc.co.uk/rss/newsonline_world_edition/africa/rss.xml',
         'http://newsrss.bbc.co.uk/rss/newsonline_world_edition/americas/rss.xml',
@@ -25,16 +27,16 @@ urls = ['http://newsrss.bbc.co.uk/rss/newsonline_world_edition/africa/rss.xml',
         'http://newsrss.bbc.co.uk/rss/newsonline_world_edition/uk_news/magazine/rss.xml']
 
 def parse_feed(cache, url):
-    bodies = {}
     stat = []
     feed = feedparser.parse(url)
     for item in feed.entries:
-        bodies[item['id']] = item.summary
         stat.append(len(item.summary.split(" ")))
-    for k in cache.seen_iterator(bodies.keys()):
-        body = bodies[k]
-        print 'Learning from %r' % (body,)
-        yield body
+    # the feeds' item IDs aren't ordered, so use the publication time
+    # as the cursor
+    for item in cache.cursor_iterator(feed.entries, 'bbc_%s' % url,
+                                      published_key, lambda item: item['id']):
+        metrics.incr('learned.bbc')
+        yield item.summary
     print "Avg len:", sum(stat)/len(stat)
 
 def update(cache):
@@ -61,12 +63,12 @@ def tweet(cache, api):
 
 
 def make_tweet(cache):
-    for x in create_sentences(cache, 20):
-        x = x.encode('utf-8')[:MAX_LENGTH].strip()
-        return x
+    for x in create_sentences(cache, 20, MAX_LENGTH):
+        return x.encode('utf-8').strip()
 
 def main(memc, username = None, password=None):
-    cache = Cache(memc)
+    metrics.configure_from_env()
+    cache = Instrumented(decaying_from_env(Cache(memc)))
     if username and password:
         print "User: %s ; PW: %s" %(username, '*' * len(password))
         api = twitter.Api(username=username,
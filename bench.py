@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+# Benchmarks for the hot paths in markov.py, run against a synthetic
+# corpus and the in-process Memory backend so that runs are
+# reproducible and don't depend on a server. Results are printed as a
+# single JSON object so that runs can be compared across changes:
+#
+#   ./bench.py [texts] [sentences] [seed] > before.json
+
+import sys
+import json
+import time
+import random
+import platform
+
+import markov
+from backends import Memory
+
+words = ["the", "a", "cat", "dog", "sat", "ran", "on", "under", "mat",
+         "i", "you", "think", "don't", "really", "like", "bacon", "it's",
+         "reddit", "comment", "upvote", "downvote", "karma", "this",
+         "that", "is", "was", "not", "so", "very", "good", "bad", "well",
+         "actually", "people", "what", "why", "because", "just", "more"]
+puncs = [",", ".", "!", "?", ";", ":"]
+
+def synthetic_corpus(n, seed):
+    """Generate `n' comment-like strings. Words are drawn with a
+       Zipf-ish distribution so that some chains are much more popular
+       than others, like in real data"""
+    rand = random.Random(seed)
+    weights = [(w, 1000 // (i+1)) for (i, w) in enumerate(words)]
+    vocab = [w for (w, weight) in weights for x in range(weight)]
+
+    corpus = []
+    for x in range(n):
+        parts = []
+        for y in range(rand.randint(5, 60)):
+            parts.append(rand.choice(vocab))
+            if rand.random() < 0.1:
+                parts.append(rand.choice(puncs))
+            if rand.random() < 0.01:
+                parts.append('http://example.com/%d' % rand.randint(0, 1000))
+        corpus.append(' '.join(parts))
+    return corpus
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values)-1, int(len(values) * p))]
+
+def timed(fn, *a):
+    start = time.time()
+    ret = fn(*a)
+    return time.time() - start, ret
+
+def bench_tokenize(corpus):
+    def run():
+        return sum(1 for text in corpus for tok in markov.Token.tokenize(text))
+    secs, tokens = timed(run)
+    return dict(tokens = tokens, secs = secs, tokens_per_sec = tokens / secs)
+
+def bench_token_followers(corpus):
+    tokenized = markov.Token.tokenize_many(corpus)
+    def run():
+        return sum(1 for tokens in tokenized for x in markov.token_followers(tokens))
+    secs, pairs = timed(run)
+    return dict(pairs = pairs, secs = secs, pairs_per_sec = pairs / secs)
+
+def bench_save_chains(corpus):
+    cache = Memory()
+    tokens = sum(len(tokens) for tokens in markov.Token.tokenize_many(corpus))
+    secs, ret = timed(markov.save_chains, cache, corpus)
+    return cache, dict(tokens = tokens, secs = secs, tokens_per_sec = tokens / secs,
+                       rows = len(cache.chains))
+
+def bench_create_sentences(cache, n, seed):
+    random.seed(seed)
+    sentences = markov.create_sentences(cache, 100)
+    latencies = []
+    lengths = []
+    for x in range(n):
+        secs, sentence = timed(next, sentences)
+        latencies.append(secs)
+        lengths.append(len(sentence))
+    return dict(sentences = n,
+                secs = sum(latencies),
+                p50_secs = percentile(latencies, 0.5),
+                p99_secs = percentile(latencies, 0.99),
+                mean_chars = float(sum(lengths)) / n)
+
+def main(texts = 5000, sentences = 1000, seed = 0):
+    texts, sentences, seed = int(texts), int(sentences), int(seed)
+    corpus = synthetic_corpus(texts, seed)
+
+    results = dict(python = platform.python_version(),
+                   texts = texts,
+                   seed = seed)
+    results['tokenize'] = bench_tokenize(corpus)
+    results['token_followers'] = bench_token_followers(corpus)
+    cache, results['save_chains'] = bench_save_chains(corpus)
+    results['create_sentences'] = bench_create_sentences(cache, sentences, seed)
+
+    print json.dumps(results, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
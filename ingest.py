@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+# Polls any number of sources concurrently, each on its own interval
+# and backing off when it fails, and feeds what they find through one
+# bounded queue into batched save_chains writes. This is threads
+# rather than an event loop, because the HTTP and store clients that
+# the sources and backends use all block.
+
+import sys
+import time
+import Queue
+import calendar
+import threading
+import traceback
+
+import metrics
+from markov import save_chains
+from backends import Cassandra as Cache, Instrumented, decaying_from_env
+
+class Source(object):
+    # A pollable source of texts: `poll(cache)' returns an iterable of
+    # the new texts found since the last call (it's usually
+    # responsible for skipping the ones it has seen with
+    # cache.cursor_iterator or cache.seen_iterator). Polls happen
+    # every `interval' seconds, and failures double the wait up to
+    # `max_backoff' seconds
+    def __init__(self, name, poll, interval, max_backoff = 30*60):
+        self.name = name
+        self.poll = poll
+        self.interval = interval
+        self.max_backoff = max_backoff
+
+    def __repr__(self):
+        return "Source(%r, %d)" % (self.name, self.interval)
+
+def reddit_source(url = None, interval = 35):
+    import redditron
+    url = url or redditron.comments_url
+    return Source(url, lambda cache: redditron.fetch_reddit_comments(cache, url),
+                  interval)
+
+def feed_source(url, interval = 5*60):
+    def poll(cache):
+        import feedparser
+        feed = feedparser.parse(url)
+        for item in cache.cursor_iterator(feed.entries, 'bbc_%s' % url,
+                                          published_key, lambda item: item['id']):
+            yield item.summary
+    return Source(url, poll, interval)
+
+def twitter_source(api, interval = 35):
+    import twittertron
+    def poll(cache):
+        status = api.GetFriendsTimeline(since_id = cache.get_cursor('twitter_timeline'),
+                                        count=200)
+        for s in cache.cursor_iterator(status, 'twitter_timeline',
+                                       twittertron._id_key, twittertron._seen_key):
+            if s.user.screen_name.lower() != api._username.lower():
+                yield s.text.encode('utf8')
+    return Source('twitter_timeline', poll, interval)
+
+def published_key(item):
+    """The cursor key for a feedparser entry: its publication time"""
+    published = item.get('published_parsed') or item.get('updated_parsed')
+    if published:
+        return calendar.timegm(published)
+
+class Runner(object):
+    def __init__(self, cache, sources, queue_size = 10*1000,
+                 batch_size = 100, batch_secs = 30):
+        self.cache = cache
+        self.sources = sources
+        self.queue = Queue.Queue(queue_size)
+        self.batch_size = batch_size
+        self.batch_secs = batch_secs
+        self.stopping = threading.Event()
+        self.chores = []
+
+    def every(self, interval, fn):
+        """Call `fn' every `interval' seconds (starting straight away)
+           alongside the pollers, e.g. for store maintenance"""
+        self.chores.append((interval, fn))
+
+    def _chore(self, interval, fn):
+        while not self.stopping.is_set():
+            try:
+                fn()
+            except Exception:
+                print "Couldn't run %s, will retry in %ds" % (fn.__name__, interval)
+                traceback.print_exc()
+            self.stopping.wait(interval)
+
+    def _poller(self, source):
+        delay = source.interval
+        while not self.stopping.is_set():
+            try:
+                for text in source.poll(self.cache):
+                    # blocks when the writer is behind
+                    self.queue.put(text)
+                delay = source.interval
+            except Exception:
+                delay = min(delay * 2, source.max_backoff)
+                print "Couldn't poll %r, will retry in %ds" % (source.name, delay)
+                traceback.print_exc()
+            self.stopping.wait(delay)
+
+    def _batch(self):
+        """Wait for up to batch_size texts or batch_secs seconds"""
+        batch = []
+        deadline = time.time() + self.batch_secs
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except Queue.Empty:
+                break
+        return batch
+
+    def start(self):
+        for source in self.sources:
+            t = threading.Thread(target=self._poller, args=(source,),
+                                 name=source.name)
+            t.daemon = True
+            t.start()
+        for interval, fn in self.chores:
+            t = threading.Thread(target=self._chore, args=(interval, fn),
+                                 name=fn.__name__)
+            t.daemon = True
+            t.start()
+
+    def stop(self):
+        self.stopping.set()
+
+    def run(self):
+        """Start the pollers and write what they find until stop() is
+           called"""
+        self.start()
+        while not self.stopping.is_set():
+            batch = self._batch()
+            if batch:
+                # one bulk write per batch
+                save_chains(self.cache, batch, batch_size=len(batch))
+
+def main(memc, *urls):
+    """Poll the reddit comments and any feed URLs given. URLs with
+       .json in them are treated as reddit listings"""
+    metrics.configure_from_env()
+    cache = Instrumented(decaying_from_env(Cache(memc)))
+    if hasattr(cache, 'start_sweeper'):
+        cache.start_sweeper()
+    sources = [reddit_source(url) if '.json' in url else feed_source(url)
+               for url in urls] or [reddit_source()]
+    runner = Runner(cache, sources)
+    if hasattr(cache, 'expire_seen'):
+        # the CouchDB backend's seen DB doesn't expire by itself
+        runner.every(24*60*60, cache.expire_seen)
+    try:
+        runner.run()
+    except KeyboardInterrupt:
+        runner.stop()
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
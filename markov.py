@@ -2,27 +2,35 @@
 
 import re
 import sys
+import gzip
+import json
+import time
+import Queue
 import random
 import itertools
+import threading
+import traceback
+import multiprocessing
+from bisect import bisect_right
 from zlib import crc32
 
+import metrics
+
 chain_length = 5
 # chains of longer lengths are weighted more heavily when picking the
 # next follower. This list defines how heavily
 chain_weights = range(1, chain_length+1)
 
+# when generating to a character budget, sentence-ending tokens are
+# favoured (up to ending_boost times more heavily) once the last
+# budget_reserve fraction of the budget is reached
+budget_reserve = 0.25
+ending_boost = 20
+
 # whether to append EndTokens to the end of token streams. Not doing
 # so biases for longer comments
 endtokens = False
 
-def trace(fn):
-    def _fn(*a, **kw):
-        sys.stderr.write('%r(%r, %r)\n' % (fn, a, kw))
-        ret = fn(*a, **kw)
-        # sys.stderr.write('%r(%r, %r): %r\n' % (fn, a, kw, ret))
-        return ret
-    return _fn
-
 class LookBehind(object):
     def __init__(self, size, init=[]):
         self.size = size
@@ -55,27 +63,69 @@ class LookBehind(object):
         return "LookBehind(%d, %r)" % (self.size, self.data)
 
 class Token(object):
+    # Tokens are interned: there is usually only one (immutable)
+    # instance for each distinct token string, so constructing them
+    # from backend results is a dict lookup and they can be used as
+    # dict keys. So that a long-running bot doesn't grow the table
+    # forever, it's emptied once it holds `max_interned' tokens (or by
+    # clear_interned). Tokens compare by value, so the ones made
+    # before that still work; they just aren't the same instances
+    __slots__ = ('tok', 'kind')
+    interned = {}
+    max_interned = 100*1000
+
     types = dict(punc = re.compile(r'[?,!;:.()]').match,
                  word = re.compile(r'[A-Za-z0-9\'-]+').match,
                  whitespace = re.compile(r'|\s+').match)
-    # must keep the splitter in sync with the types. None of these can
-    # include pipes because we use them as a meta-character
-    split_re = re.compile(r'(\s+|[A-Za-z0-9\'-]+|[?,!;:.()])')
-    skip_re  = re.compile(r'^http.*') # tokens to skip when
-                                      # tokenising. these are before
-                                      # the split_re is applied
+    # must keep the scanner in sync with the types. None of these can
+    # include pipes because we use them as a meta-character. Any
+    # space-separated word starting with http is skipped, as is
+    # anything that the groups don't match (including the separator
+    # that tokenize_many puts between texts)
+    scan_re = re.compile(r'(?P<url>(?:^|(?<= ))http[^ ]*)'
+                         r'|(?P<word>[A-Za-z0-9\'-]+)'
+                         r'|(?P<punc>[?,!;:.()])'
+                         r'|(?P<sep>\x00)')
+    scan_kinds = ('word', 'punc')
     capnexts = '?!.'
     nospaces_after = '('
 
-    def __init__(self, tok, kind = None):
-        self.tok = tok.lower()
-        self.kind = kind or self._kind()
+    def __new__(cls, tok, kind = None):
+        try:
+            return cls.interned[tok]
+        except KeyError:
+            tok = tok.lower()
+            try:
+                return cls.interned[tok]
+            except KeyError:
+                pass
+
+        self = object.__new__(cls)
+        object.__setattr__(self, 'tok', tok)
+        object.__setattr__(self, 'kind', kind or cls._kind(tok))
+        if len(cls.interned) >= cls.max_interned:
+            cls.clear_interned()
+        cls.interned[tok] = self
+        return self
+
+    @classmethod
+    def clear_interned(cls):
+        """Forget the interned tokens"""
+        Token.interned = {}
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Tokens are immutable")
+
+    def __reduce__(self):
+        # re-intern on unpickling
+        return (Token, (self.tok, self.kind))
 
-    def _kind(self):
-        for (t, fn) in self.types.iteritems():
-            if fn(self.tok):
+    @classmethod
+    def _kind(cls, tok):
+        for (t, fn) in cls.types.iteritems():
+            if fn(tok):
                 return t
-        raise TypeError('Unknown token type %r' % self)
+        raise TypeError('Unknown token type %r' % (tok,))
 
     @classmethod
     def tokenize(cls, text, beginend = True):
@@ -83,21 +133,44 @@ class Token(object):
            parsed from it"""
         if beginend:
             yield BeginToken()
-        for x in text.split(' '):
-            if not cls.skip_re.match(x):
-                for y in cls.split_re.split(x):
-                    tok = cls(y)
-                    if tok.kind != 'whitespace':
-                        yield tok
+        for m in cls.scan_re.finditer(text):
+            if m.lastgroup in cls.scan_kinds:
+                yield cls(m.group(), m.lastgroup)
         if beginend and endtokens:
             yield EndToken()
 
+    @classmethod
+    def tokenize_many(cls, texts, beginend = True):
+        """Given a list of strings of text, return a list of the lists
+           of tokens parsed from each of them, in a single pass over
+           all of them"""
+        current = [BeginToken()] if beginend else []
+        ret = [current]
+        joined = ' \x00 '.join(text.replace('\x00', ' ') for text in texts)
+        for m in cls.scan_re.finditer(joined):
+            if m.lastgroup in cls.scan_kinds:
+                current.append(cls(m.group(), m.lastgroup))
+            elif m.lastgroup == 'sep':
+                if beginend and endtokens:
+                    current.append(EndToken())
+                current = [BeginToken()] if beginend else []
+                ret.append(current)
+        if beginend and endtokens:
+            current.append(EndToken())
+        return ret if texts else []
+
     def __repr__(self):
         return "Token(%r, %r)" % (self.tok, self.kind)
 
     def __eq__(self, other):
         return (isinstance(other, Token)
-                and (self.tok, other.type) == (other.tok, other.type))
+                and (self.tok, self.kind) == (other.tok, other.kind))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.tok)
 
 
     @classmethod
@@ -127,23 +200,32 @@ class Token(object):
             lookbehind.append(tok)
 
 class BeginToken(Token):
+    __slots__ = ()
     tok = 'BeginToken'
     kind = 'special'
 
-    def __init__(self):
-        pass
+    def __new__(cls):
+        return cls.instance
+    def __reduce__(self):
+        return (BeginToken, ())
     def __repr__(self):
         return "BeginToken()"
 
 class EndToken(Token):
+    __slots__ = ()
     tok = 'EndToken'
     kind = 'special'
 
-    def __init__(self):
-        pass
+    def __new__(cls):
+        return cls.instance
+    def __reduce__(self):
+        return (EndToken, ())
     def __repr__(self):
         return "EndToken()"
 
+BeginToken.instance = object.__new__(BeginToken)
+EndToken.instance = object.__new__(EndToken)
+
 def limit(it, lim=None):
     if lim == 0:
         return
@@ -198,32 +280,121 @@ def token_predecessors(lb):
 def _count_key(h, follower):
     return "%s_%s" % (h, crc32(follower))
 
-def save_chains(cache, it):
+def count_followers(deltas, text):
+    """Add the follower counts for the chains in the string `text' to
+       `deltas', a dict(tuple(str) -> dict(str -> count)) keyed by the
+       predecessor tokens, returning the number of tokens counted"""
+    return _count_tokens(deltas, Token.tokenize(text))
+
+def _count_tokens(deltas, tokens):
+    tokens = list(tokens)
+    for preds, token in token_followers(tokens):
+        followers = deltas.setdefault(tuple(p.tok for p in preds), {})
+        followers[token.tok] = followers.get(token.tok, 0) + 1
+    return len(tokens)
+
+def merge_deltas(into, deltas):
+    """Add the follower counts in `deltas' to `into'"""
+    for preds, followers in deltas.iteritems():
+        existing = into.get(preds)
+        if existing is None:
+            into[preds] = followers
+        else:
+            for tok, count in followers.iteritems():
+                existing[tok] = existing.get(tok, 0) + count
+
+def save_chains(cache, it, batch_size=100, batch_secs=60):
     """Turn all of the strings yielded by `it' into chains and save
-       them to memcached"""
-    for cm in it:
-        tokens = Token.tokenize(cm)
-        followers = token_followers(tokens)
-        for preds, token in followers:
-            cache.incr_follower(preds, token)
+       them to the cache. Follower counts are aggregated in memory
+       and written with one bulk operation every `batch_size' strings
+       or `batch_secs' seconds, whichever comes first"""
+    deltas = {}
+    pending = 0
+    tokens = 0
+    # seconds spent counting the pending strings, as opposed to
+    # waiting for `it' to yield them
+    busy = 0.0
+    started = None
+
+    def flush():
+        start = time.time()
+        cache.incr_followers_bulk(deltas)
+        secs = time.time() - start
+        metrics.timing('markov.save_chains.flush', secs)
+        metrics.incr('markov.save_chains.texts', pending)
+        metrics.incr('markov.save_chains.tokens', tokens)
+        if busy + secs > 0:
+            metrics.observe('markov.save_chains.tokens_per_sec',
+                            tokens / (busy + secs))
 
-def create_chain(cache):
+    for cm in it:
+        if not pending:
+            started = time.time()
+        start = time.time()
+        tokens += count_followers(deltas, cm)
+        busy += time.time() - start
+        pending += 1
+
+        # `it' is usually a generator that sleeps between polls, so
+        # the time window is only checked as new strings arrive
+        if pending >= batch_size or time.time() - started >= batch_secs:
+            flush()
+            deltas = {}
+            pending = tokens = 0
+            busy = 0.0
+
+    if deltas:
+        flush()
+
+def weighted_choice(weights):
+    """Given an iterable of (item, weight) pairs with integer weights,
+       pick an item with probability proportional to its weight. So
+       given [(a, 2), (b, 3)], pick a 2/5ths of the time"""
+    items = []
+    cumulative = []
+    total = 0
+    for item, weight in weights:
+        total += weight
+        items.append(item)
+        cumulative.append(total)
+    return items[bisect_right(cumulative, random.randrange(total))]
+
+def _token_width(tok, prev):
+    """The number of characters that detokenize will use for `tok'
+       when it follows `prev'"""
+    if isinstance(tok, EndToken):
+        return 0
+    width = len(tok.tok)
+    if (not isinstance(prev, BeginToken)
+        and tok.kind == 'word'
+        and prev.tok not in Token.nospaces_after):
+        width += 1
+    return width
+
+def _is_ending(tok):
+    return isinstance(tok, EndToken) or tok.tok in Token.capnexts
+
+def create_chain(cache, budget = None):
     """Read the chains created by save_chains from memcached and yield
-       a stream of predicted tokens"""
+       a stream of predicted tokens. If a `budget' of characters is
+       given, the detokenized chain will fit in it, and it's steered
+       towards ending a sentence as the budget runs out"""
     lb = LookBehind(chain_length, [BeginToken()])
+    used = 0
+    reserve = budget * budget_reserve if budget else 0
 
     while True:
-        potential_followers = []
+        potential_followers = {}
         all_preds = list(token_predecessors(lb))
 
         # build up the weights for the next token based on
-        # occurrence-counts in the source data * the length
-        # weight. build a list by duplicating the items according to
-        # their weight. So given {a: 2, b: 3}, generate the list
-        # [a, a, b, b, b]
-        for preds in all_preds:
-            for f, weight in cache.get_followers(preds).iteritems():
-                potential_followers.extend([f] * (weight * chain_weights[len(preds)-1]))
+        # occurrence-counts in the source data * the length weight,
+        # merging the followers found for each length of chain
+        all_followers = cache.get_followers_multi(all_preds)
+        for preds, followers in zip(all_preds, all_followers):
+            for f, weight in followers.iteritems():
+                potential_followers[f] = (potential_followers.get(f, 0)
+                                          + weight * chain_weights[len(preds)-1])
 
         if not potential_followers:
             # no idea what the next token should be. This should only
@@ -232,7 +403,22 @@ def create_chain(cache):
             # followers, it would at least have an EndToken follower)
             break
 
-        next = random.choice(potential_followers)
+        if budget is not None:
+            remaining = budget - used
+            # only consider the followers that fit, and favour the
+            # ones that would end the sentence more heavily the
+            # closer we get to the end of the budget
+            boost = 1
+            if remaining < reserve:
+                boost += int(ending_boost * (reserve - remaining) / reserve)
+            potential_followers = dict((f, weight * boost if _is_ending(f) else weight)
+                                       for (f, weight)
+                                       in potential_followers.iteritems()
+                                       if _token_width(f, lb[0]) <= remaining)
+            if not potential_followers:
+                break
+
+        next = weighted_choice(potential_followers.iteritems())
 
         if next.tok == EndToken.tok:
             break
@@ -241,24 +427,220 @@ def create_chain(cache):
 
         lb.append(next)
 
-def create_sentences(cache, length):
+        if budget is not None:
+            used += _token_width(next, lb[1])
+            if _is_ending(next) and budget - used < reserve:
+                break
+
+def create_sentences(cache, length, budget = None):
     """Create chains with create_chain and yield lines that look like
-       English sentences"""
+       English sentences, of no more than `length' tokens, or of no
+       more than `budget' characters if it's given. The budget takes
+       the place of the token limit, since cutting the chain off
+       short of it would stop the sentence before it was steered
+       towards an ending"""
     while True:
-        chain = limit(create_chain(cache), length)
-        yield ''.join(Token.detokenize(chain))
-
-def cleanup(cache, count):
-    all_decrs, all_removals, all_keys_modified = cache.cleanup(decr=count)
+        start = time.time()
+        chain = create_chain(cache, budget)
+        if budget is None:
+            chain = limit(chain, length)
+        chain = list(chain)
+        sentence = ''.join(Token.detokenize(chain))
+        metrics.timing('markov.sentence', time.time() - start)
+        metrics.observe('markov.sentence.tokens', len(chain))
+        yield sentence
+
+class SentencePool(object):
+    # Keeps up to `size' ready-made sentences, generated from `cache'
+    # by a background thread, so that they can be handed out without
+    # waiting for generation. Only sentences of at least `min_words'
+    # words and at most `max_chars' bytes of UTF-8 are kept
+    def __init__(self, cache, size = 20, length = 100,
+                 max_chars = None, min_words = 3):
+        self.cache = cache
+        self.length = length
+        self.max_chars = max_chars
+        self.min_words = min_words
+        self.sentences = Queue.Queue(size)
+
+        self.thread = threading.Thread(target=self._produce,
+                                       name='SentencePool')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def acceptable(self, sentence):
+        return (len(sentence.split()) >= self.min_words
+                and (self.max_chars is None
+                     or len(sentence.encode('utf-8')) <= self.max_chars))
+
+    def _produce(self):
+        while True:
+            try:
+                for sentence in create_sentences(self.cache, self.length,
+                                                 self.max_chars):
+                    if not sentence:
+                        # the model is empty, don't spin on it
+                        time.sleep(1)
+                    elif self.acceptable(sentence):
+                        # blocks while the pool is full
+                        self.sentences.put(sentence)
+            except Exception:
+                print "Couldn't generate sentences, will retry"
+                traceback.print_exc()
+                time.sleep(60)
+
+    def get(self, timeout = 60):
+        """Take a sentence from the pool, or return None if none
+           turned up within `timeout' seconds"""
+        try:
+            return self.sentences.get(timeout=timeout)
+        except Queue.Empty:
+            return None
+
+def read_corpus(path):
+    """Yield the texts in the corpus file at `path'. Files named
+       *.json or *.jsonl hold one reddit comment (or reddit API
+       listing child) per line, anything else is plain text with one
+       text per line. Either can be gzipped (*.gz)"""
+    name = path[:-3] if path.endswith('.gz') else path
+    is_json = name.endswith(('.json', '.jsonl'))
+
+    f = gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+    try:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if not is_json:
+                yield line.decode('utf-8', 'replace')
+                continue
+            try:
+                cm = json.loads(line)
+            except ValueError:
+                continue
+            if not isinstance(cm, dict):
+                continue
+            if 'data' in cm:
+                cm = cm['data']
+            body = cm.get('body')
+            if body and body not in ('[deleted]', '[removed]'):
+                yield body
+    finally:
+        f.close()
+
+def _count_texts(texts):
+    """Process pool worker for `train'"""
+    deltas = {}
+    for tokens in Token.tokenize_many(texts):
+        _count_tokens(deltas, tokens)
+    return deltas
+
+def train(cache, path, processes = None, chunk_size = 1000, flush_chunks = 100):
+    """Train the model in `cache' from the corpus file at `path'
+       (see read_corpus). Chunks of `chunk_size' texts are counted by
+       a pool of worker processes and the merged counts are written
+       with incr_followers_bulk every `flush_chunks' chunks"""
+    processes = processes or multiprocessing.cpu_count()
+    texts = read_corpus(path)
+    chunks = iter(lambda: list(itertools.islice(texts, chunk_size)), [])
+
+    pool = multiprocessing.Pool(processes)
+    deltas = {}
+    pending = 0
+    all_texts = 0
+    all_rows = 0
+    try:
+        while True:
+            # only hand the pool a few chunks at a time, otherwise it
+            # would read the whole corpus into its task queue
+            window = list(itertools.islice(chunks, processes * 2))
+            if not window:
+                break
+            for chunk_deltas in pool.imap_unordered(_count_texts, window):
+                merge_deltas(deltas, chunk_deltas)
+            pending += len(window)
+            all_texts += sum(len(chunk) for chunk in window)
+
+            if pending >= flush_chunks:
+                cache.incr_followers_bulk(deltas)
+                all_rows += len(deltas)
+                print "%d texts trained, %d rows written" % (all_texts, all_rows)
+                deltas = {}
+                pending = 0
+
+        if deltas:
+            cache.incr_followers_bulk(deltas)
+            all_rows += len(deltas)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    return all_texts, all_rows
+
+# the cache used by each generate_batch worker process
+_worker_cache = None
+
+def _init_generator(backend, init_args):
+    """Process pool initializer for `generate_batch'"""
+    global _worker_cache
+    from backends import Cached, decaying_from_env
+    _worker_cache = Cached(decaying_from_env(backend(init_args)))
+    # otherwise every forked worker would generate the same sentences
+    random.seed()
+
+def _generate(args):
+    """Process pool worker for `generate_batch'"""
+    length, budget = args
+    start = time.time()
+    sentence = next(create_sentences(_worker_cache, length, budget))
+    return sentence, time.time() - start
+
+def generate_batch(backend, init_args, n, processes = None, out = sys.stdout,
+                   length = 100, budget = None):
+    """Generate `n' sentences across a pool of worker processes, each
+       with its own `backend(init_args)', writing them to `out' as
+       JSON lines with the time each took. Backends like Compiled let
+       the workers share one read-only snapshot of the model"""
+    pool = multiprocessing.Pool(processes, _init_generator, (backend, init_args))
+    start = time.time()
+    try:
+        for sentence, secs in pool.imap_unordered(_generate,
+                                                  itertools.repeat((length, budget), n),
+                                                  chunksize = 16):
+            out.write(json.dumps(dict(sentence = sentence, secs = secs)) + '\n')
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return n, time.time() - start
+
+def cleanup(cache, count, progress_secs = 10):
+    last = [time.time()]
+    def progress(rows, all_decrs, all_removals, all_keys_modified):
+        if time.time() - last[0] >= progress_secs:
+            last[0] = time.time()
+            print ("%d rows scanned: %d columns decremented, %d columns removed"
+                   % (rows, all_decrs, all_removals))
+
+    all_decrs, all_removals, all_keys_modified = cache.cleanup(decr=count,
+                                                               progress=progress)
     print ("%d columns decremented, %d columns removed, over %d rows"
            % (all_decrs, all_removals, all_keys_modified))
 
-def main(memc, op, lim = None):
-    from backends import Cassandra as Cache
-    cache = Cache(memc)
+def main(memc, op, lim = None, *args):
+    from backends import Cassandra as Cache, Instrumented, decaying_from_env
+    metrics.configure_from_env()
+    cache = Instrumented(decaying_from_env(Cache(memc)))
 
     try:
         if op == 'gen':
+            from backends import Cached
+            cache = Cached(cache)
             lim = int(lim) if lim else None
             for x in limit(create_sentences(cache, 100), lim):
                 if x:
@@ -266,6 +648,68 @@ def main(memc, op, lim = None):
         elif op == 'cleanup':
             count = int(lim) if lim else 10
             cleanup(cache, count)
+        elif op == 'sweep':
+            # catch up the decay of the chains that nobody has touched,
+            # with REDDITRON_DECAY set
+            if not hasattr(cache, 'sweep'):
+                print "REDDITRON_DECAY isn't set"
+                return
+            rows, decayed, removed = cache.sweep()
+            print "%d rows scanned: %d decayed, %d removed" % (rows, decayed, removed)
+        elif op == 'expire':
+            # forget the old seen records, for backends (CouchDB)
+            # that can't expire them by themselves. ingest does this
+            # once a day
+            if not hasattr(cache, 'expire_seen'):
+                print "This backend expires seen records by itself"
+                return
+            print "%d seen records expired" % cache.expire_seen()
+        elif op == 'compile':
+            from backends import compile_model
+            rows, followers = compile_model(cache, lim)
+            print "compiled %d rows, %d followers to %s" % (rows, followers, lim)
+        elif op == 'export':
+            # export <path> [top_k] [min_count] [levels]
+            from backends import export_model
+            top_k = int(args[0]) if args else None
+            min_count = int(args[1]) if len(args) > 1 else 1
+            levels = int(args[2]) if len(args) > 2 else None
+            stats = export_model(cache, lim, top_k, min_count, levels)
+            print ("exported %d of %d rows, %d of %d followers to %s"
+                   % (stats['exported_rows'], stats['rows'],
+                      stats['exported_followers'], stats['followers'], lim))
+            print ("%d bytes, down from %d (%.1f%%)"
+                   % (stats['exported_bytes'], stats['bytes'],
+                      100.0 * stats['exported_bytes'] / stats['bytes']))
+            print ("follower distributions moved by %.4f on average (total"
+                   " variation distance), %.4f at most"
+                   % (stats['mean_tvd'], stats['max_tvd']))
+        elif op == 'train':
+            processes = int(args[0]) if args else None
+            all_texts, all_rows = train(cache, lim, processes)
+            print "trained %d texts, %d rows written" % (all_texts, all_rows)
+        elif op == 'migrate':
+            # migrate [vocabulary size]: rewrite the chains with keys=compact
+            from backends import build_vocabulary, migrate_keys
+            size = int(lim) if lim else 64*1024
+            # an interrupted migration is finished with the vocabulary
+            # it started with
+            vocabulary = (Cache(memc).load_vocabulary()
+                          or build_vocabulary(Cache(memc), size))
+            migrated = migrate_keys(Cache(memc + ',keys=compact'))
+            print ("%d chains migrated, with a vocabulary of %d tokens"
+                   % (migrated, len(vocabulary)))
+        elif op == 'batch':
+            # batch <count> [processes] [compiled model file]
+            processes = int(args[0]) if args else None
+            if len(args) > 1:
+                from backends import Compiled
+                backend, init_args = Compiled, args[1]
+            else:
+                backend, init_args = Cache, memc
+            n, secs = generate_batch(backend, init_args, int(lim), processes)
+            sys.stderr.write("%d sentences in %.1fs (%.1f sentences/s)\n"
+                             % (n, secs, n / secs))
         else:
             print "Unknown op %r" % (op,)
 
@@ -0,0 +1,183 @@
+# Counters and timings for the hot paths. Code that wants to be
+# measured calls the module-level incr/timing/observe (or uses
+# `timer'), and they're forwarded to the current sink, which does
+# nothing until one is configured:
+#
+#   metrics.configure('memory')          # kept in-process, see snapshot()
+#   metrics.configure('log')             # one line per metric to stderr
+#   metrics.configure('statsd')          # UDP to localhost:8125
+#   metrics.configure('statsd:host:port')
+#
+# The bots configure it from the REDDITRON_METRICS environment variable
+
+import os
+import sys
+import time
+import socket
+import threading
+from bisect import bisect_left
+
+class NullSink(object):
+    def incr(self, name, n = 1):
+        pass
+
+    def timing(self, name, secs):
+        pass
+
+    def observe(self, name, value):
+        pass
+
+class Histogram(object):
+    # A fixed set of exponentially-spaced buckets, so that it can be
+    # kept for as long as the process runs without growing. They're a
+    # quarter-power of two apart, covering ~1e-7 to ~1e12, and
+    # percentiles are reported as the upper bound of the bucket that
+    # they fall in, so they're within 19% of the real value
+    bounds = [2 ** (x / 4.0) for x in range(-96, 160)]
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.buckets[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, p):
+        if not self.count:
+            return None
+        want = p * self.count
+        seen = 0
+        for bound, n in zip(self.bounds, self.buckets):
+            seen += n
+            if seen >= want:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return dict(count = self.count,
+                    mean = self.total / self.count if self.count else None,
+                    p50 = self.percentile(0.5),
+                    p99 = self.percentile(0.99),
+                    max = self.max)
+
+class MemorySink(object):
+    # Keeps everything in-process: counters as totals, and timings and
+    # observations as Histograms
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def incr(self, name, n = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def timing(self, name, secs):
+        self.observe(name, secs)
+
+    def observe(self, name, value):
+        with self.lock:
+            hist = self.histograms.get(name)
+            if hist is None:
+                hist = self.histograms[name] = Histogram()
+            hist.add(value)
+
+    def snapshot(self):
+        """snapshot() -> dict(counters = dict(name -> count),
+                              histograms = dict(name -> summary))"""
+        with self.lock:
+            return dict(counters = dict(self.counters),
+                        histograms = dict((name, hist.summary())
+                                          for (name, hist)
+                                          in self.histograms.iteritems()))
+
+class LogSink(object):
+    def __init__(self, out = sys.stderr):
+        self.out = out
+
+    def _write(self, line):
+        self.out.write('%s %s\n' % (time.strftime('%Y-%m-%d %H:%M:%S'), line))
+
+    def incr(self, name, n = 1):
+        self._write('%s +%d' % (name, n))
+
+    def timing(self, name, secs):
+        self._write('%s %.3fms' % (name, secs * 1000))
+
+    def observe(self, name, value):
+        self._write('%s %r' % (name, value))
+
+class StatsdSink(object):
+    # Sends each metric as a StatsD datagram. It's fire-and-forget, so
+    # a missing daemon costs nothing but the send
+    def __init__(self, host = 'localhost', port = 8125, prefix = 'redditron.'):
+        self.addr = (host, int(port))
+        self.prefix = prefix
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _send(self, stat):
+        try:
+            self.sock.sendto(self.prefix + stat, self.addr)
+        except socket.error:
+            pass
+
+    def incr(self, name, n = 1):
+        self._send('%s:%d|c' % (name, n))
+
+    def timing(self, name, secs):
+        self._send('%s:%.3f|ms' % (name, secs * 1000))
+
+    def observe(self, name, value):
+        self._send('%s:%r|h' % (name, value))
+
+sink = NullSink()
+
+def configure(spec):
+    """Set the sink from a spec string like 'memory', 'log', 'statsd' or
+       'statsd:host:port' and return it. An empty spec turns metrics
+       off"""
+    global sink
+    parts = spec.split(':') if spec else ['none']
+    if parts[0] == 'none':
+        sink = NullSink()
+    elif parts[0] == 'memory':
+        sink = MemorySink()
+    elif parts[0] == 'log':
+        sink = LogSink()
+    elif parts[0] == 'statsd':
+        sink = StatsdSink(*parts[1:])
+    else:
+        raise ValueError("Unknown metrics sink %r" % (spec,))
+    return sink
+
+def configure_from_env():
+    return configure(os.environ.get('REDDITRON_METRICS'))
+
+def incr(name, n = 1):
+    sink.incr(name, n)
+
+def timing(name, secs):
+    sink.timing(name, secs)
+
+def observe(name, value):
+    sink.observe(name, value)
+
+class timer(object):
+    # Records how long its block takes under `name':
+    #
+    #   with metrics.timer('backend.get_followers'):
+    #       ...
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        sink.timing(self.name, time.time() - self.start)
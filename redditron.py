@@ -5,31 +5,41 @@ from urllib2 import urlopen
 import simplejson as json
 import time
 
+import metrics
 from markov import save_chains
-from backends import Cassandra as Cache
+from backends import Cassandra as Cache, Instrumented, decaying_from_env
 
 def main(memc):
-    cache = Cache(memc)
+    metrics.configure_from_env()
+    cache = Instrumented(decaying_from_env(Cache(memc)))
     comments = get_reddit_comments(cache)
     save_chains(cache, comments)
 
-def get_reddit_comments(cache):
-    """Continually yield new comment-bodies from reddit.com"""
-    url = 'http://www.reddit.com/comments.json?limit=100'
+comments_url = 'http://www.reddit.com/comments.json?limit=100'
 
+def get_reddit_comments(cache, url = comments_url):
+    """Continually yield new comment-bodies from reddit.com"""
     while True:
-        s = urlopen(url).read().decode('utf8')
-
-        js = json.loads(s)
-        cms = js['data']['children']
-
-        for cm in cache.seen_iterator(cms, lambda cm: cm['data']['id']):
-            body = cm['data']['body']
-            author = cm['data']['author']
-            print 'Learning from %s: %r' % (author, body)
+        for body in fetch_reddit_comments(cache, url):
             yield body
 
         time.sleep(35)
 
+def fetch_reddit_comments(cache, url = comments_url):
+    """Yield the comment-bodies from one fetch of `url' that haven't
+       been seen before"""
+    s = urlopen(url).read().decode('utf8')
+
+    js = json.loads(s)
+    cms = js['data']['children']
+
+    source = 'reddit_comments' if url == comments_url else 'reddit_%s' % url
+    # reddit IDs are base-36 and increase over time
+    for cm in cache.cursor_iterator(cms, source,
+                                    lambda cm: int(cm['data']['id'], 36),
+                                    lambda cm: cm['data']['id']):
+        metrics.incr('learned.reddit')
+        yield cm['data']['body']
+
 if __name__=='__main__':
     main(*sys.argv[1:])
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+# Tests for the key encodings and migrate_keys. The Redis backend is
+# run against FakeRedis, which keeps its hashes in a dict, so they
+# don't need a server:
+#
+#   python -m unittest test_keys
+
+import unittest
+
+import backends
+from backends import StringKeys, CompactKeys, build_vocabulary, migrate_keys
+from markov import Token
+
+class FakePipeline(object):
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def __getattr__(self, name):
+        def queue(*a):
+            self.commands.append((name, a))
+            return self
+        return queue
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        return [getattr(self.client, name)(*a) for (name, a) in commands]
+
+class FakeRedis(object):
+    # just enough of redis.Redis for the follower hashes and the
+    # vocabulary
+    def __init__(self):
+        self.data = {}
+
+    def pipeline(self, transaction = True):
+        return FakePipeline(self)
+
+    def hgetall(self, key):
+        return dict((k, str(v)) for (k, v) in self.data.get(key, {}).iteritems())
+
+    def hincrby(self, key, field, n):
+        h = self.data.setdefault(key, {})
+        h[field] = h.get(field, 0) + n
+        return h[field]
+
+    def hset(self, key, field, value):
+        self.data.setdefault(key, {})[field] = int(value)
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    def scan_iter(self, count = None):
+        return iter(list(self.data))
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def setnx(self, key, value):
+        if key in self.data:
+            return False
+        self.data[key] = value
+        return True
+
+def redis_backend(client, keys = 'strings'):
+    # Redis.__init__ connects, so fill it in by hand
+    cache = backends.Redis.__new__(backends.Redis)
+    cache.client = client
+    cache.seen_filter = backends.SeenFilter()
+    cache.codec = backends._key_codec(cache, {'keys': keys})
+    return cache
+
+class CompactKeysTest(unittest.TestCase):
+    def setUp(self):
+        # enough tokens that some IDs take two bytes
+        self.vocabulary = ['the', 'cat', u'caf\xe9'] + ['w%d' % i for i in range(300)]
+        self.codec = CompactKeys(self.vocabulary)
+
+    def test_vocabulary_tokens(self):
+        for toks in [('the',), ('the', 'cat'), ('w0', 'w299', 'cat')]:
+            key = self.codec.key(toks)
+            self.assertTrue(self.codec.owns(key))
+            self.assertEqual(self.codec.unkey(key), toks)
+        self.assertEqual(len(self.codec.column('the')), 1)
+        self.assertEqual(len(self.codec.column('w299')), 2)
+
+    def test_other_tokens(self):
+        toks = ('the', 'zebra', 'cat', 'BeginToken')
+        self.assertEqual(self.codec.unkey(self.codec.key(toks)), toks)
+        for tok in ['zebra', 'EndToken', 'the', 'w150']:
+            self.assertEqual(self.codec.uncolumn(self.codec.column(tok)), tok)
+
+    def test_unicode(self):
+        # tokens come back as UTF-8
+        cafe = u'caf\xe9'.encode('utf-8')
+        self.assertEqual(self.codec.unkey(self.codec.key([u'caf\xe9', u'na\xefve'])),
+                         (cafe, u'na\xefve'.encode('utf-8')))
+        self.assertEqual(self.codec.uncolumn(self.codec.column(cafe)), cafe)
+
+    def test_long_tokens(self):
+        # their lengths take more than one byte of varint
+        for n in [127, 128, 300, 20000]:
+            tok = 'x' * n
+            self.assertEqual(self.codec.uncolumn(self.codec.column(tok)), tok)
+            toks = (tok, 'cat', tok + 'y')
+            self.assertEqual(self.codec.unkey(self.codec.key(toks)), toks)
+
+    def test_encodings_dont_overlap(self):
+        strings = StringKeys()
+        for toks in [('the', 'cat'), ('zebra',)]:
+            self.assertFalse(strings.owns(self.codec.key(toks)))
+            self.assertFalse(self.codec.owns(strings.key(toks)))
+
+class MigrateKeysTest(unittest.TestCase):
+    chains = {('BeginToken',): {'the': 5, 'a': 2},
+              ('BeginToken', 'the'): {'cat': 3, 'zebra': 2},
+              ('the',): {'cat': 3, 'zebra': 2},
+              ('the', 'zebra'): {'EndToken': 2},
+              ('x' * 200,): {'cat': 1}}
+
+    def setUp(self):
+        self.client = FakeRedis()
+        strings = redis_backend(self.client)
+        strings.incr_followers_bulk(self.chains)
+        build_vocabulary(strings, 3)
+        self.compact = redis_backend(self.client, 'compact')
+
+    def stored(self, codec):
+        return dict(self.compact._all_followers(codec))
+
+    def test_migrate(self):
+        self.assertEqual(migrate_keys(self.compact, batch_size = 2), len(self.chains))
+        self.assertEqual(self.stored(self.compact.codec), self.chains)
+        self.assertEqual(self.stored(StringKeys()), {})
+        self.assertEqual(self.compact.get_followers([Token('the')]),
+                         {Token('cat'): 3, Token('zebra'): 2})
+
+    def test_interrupted(self):
+        # fail after copying the first batch but before deleting it
+        delete = self.compact._delete
+        def fail(codec, keys):
+            raise IOError("interrupted")
+        self.compact._delete = fail
+        self.assertRaises(IOError, migrate_keys, self.compact, 2)
+        self.compact._delete = delete
+
+        self.assertEqual(migrate_keys(self.compact, batch_size = 2), len(self.chains))
+        self.assertEqual(self.stored(self.compact.codec), self.chains)
+        self.assertEqual(self.stored(StringKeys()), {})
+
+    def test_rerun(self):
+        migrate_keys(self.compact)
+        self.assertEqual(migrate_keys(self.compact), 0)
+        self.assertEqual(self.stored(self.compact.codec), self.chains)
+
+if __name__ == '__main__':
+    unittest.main()
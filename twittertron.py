@@ -7,13 +7,15 @@ import time
 import twitter
 import urllib2 # python-twitter throws exceptions from here
 
-from markov import save_chains, create_sentences, limit
-from backends import Cassandra as Cache
+import metrics
+from markov import save_chains, create_sentences, limit, SentencePool
+from backends import Cassandra as Cache, Instrumented, decaying_from_env
 
 MAX_LENGTH = 140
 
 def main(memc, op, username = '', password = '', newfriendname = ''):
-    cache = Cache(memc)
+    metrics.configure_from_env()
+    cache = Instrumented(decaying_from_env(Cache(memc)))
 
     if username and password:
         api = twitter.Api(username=username,
@@ -30,11 +32,13 @@ def main(memc, op, username = '', password = '', newfriendname = ''):
         save_chains(cache, status)
 
     elif op == 'commands':
-        process_commands(cache, api)
+        pool = SentencePool(cache, max_chars=MAX_LENGTH)
+        process_commands(cache, api, pool)
 
     elif op == 'tweet':
+        pool = SentencePool(cache, max_chars=MAX_LENGTH)
         while True:
-            x = make_tweet(cache)
+            x = make_tweet(cache, pool)
             if x:
                 print 'tweeting: %r' % x
                 try:
@@ -48,23 +52,27 @@ def main(memc, op, username = '', password = '', newfriendname = ''):
     else:
         raise ValueError('unkown op %r?' % op)
 
-def make_tweet(cache):
-    for x in create_sentences(cache, 100):
-        x = x.encode('utf-8')[:MAX_LENGTH].strip()
-        return x
+def make_tweet(cache, pool = None):
+    if pool is not None:
+        # the pool only holds sentences that fit
+        x = pool.get()
+        return x.encode('utf-8') if x else x
+
+    for x in create_sentences(cache, 100, MAX_LENGTH):
+        return x.encode('utf-8').strip()
 
 follow_cmd_re = re.compile('^follow @?([A-Za-z0-9_]+)$')
 tweetme_cmd_re = re.compile('^tweetme$')
-def process_commands(cache, api):
+def process_commands(cache, api, pool = None):
     while True:
         try:
-            dms = api.GetDirectMessages()
+            dms = api.GetDirectMessages(since_id = cache.get_cursor('twitter_dms'))
         except urllib2.HTTPError, e:
             print "Couldn't get direct messages, will retry", e
             time.sleep(120)
             continue
 
-        for dm in cache.seen_iterator(dms, _seen_key):
+        for dm in cache.cursor_iterator(dms, 'twitter_dms', _id_key, _seen_key):
             follow_cmd_match = follow_cmd_re.match(dm.text.lower())
             tweetme_cmd_match = not follow_cmd_match and tweetme_cmd_re.match(dm.text.lower())
 
@@ -86,7 +94,7 @@ def process_commands(cache, api):
 
             elif tweetme_cmd_match:
                 # someone wants us to send them a one-time tweet
-                tweet = make_tweet(cache)
+                tweet = make_tweet(cache, pool)
                 if tweet:
                     print 'Tweeting to %r: %r' % (dm.sender_screen_name, tweet)
                     try:
@@ -100,43 +108,41 @@ def process_commands(cache, api):
         time.sleep(60)
 
 def get_twitter_status(cache, api):
-    last = None
-
     while True:
         # the plural of status is status
         try:
-            status = api.GetFriendsTimeline(since_id = last, count=200)
+            status = api.GetFriendsTimeline(since_id = cache.get_cursor('twitter_timeline'),
+                                            count=200)
         except urllib2.HTTPError, e:
             print "Couldn't get timeline, will retry", e
             time.sleep(120)
             continue
 
-        status = cache.seen_iterator(status, _seen_key)
+        status = cache.cursor_iterator(status, 'twitter_timeline', _id_key, _seen_key)
 
-        s = None
         for s in status:
             if s.user.screen_name.lower() != api._username.lower():
-                text = s.text.encode('utf8')
-                print 'Learning from %s: %r' % (s.user.screen_name, text)
-                yield text
-
-        if s is not None:
-            last = s.id
+                metrics.incr('learned.twitter_timeline')
+                yield s.text.encode('utf8')
 
         # 35 looks to be optimal for preventing rate-limiting
         # http://apiwiki.twitter.com/Rate-limiting
         time.sleep(35)
 
 def load_user(cache, api, newfriendname):
-    status = api.GetUserTimeline(newfriendname, count=200)
-    status = cache.seen_iterator(status, _seen_key)
+    source = 'twitter_user_%s' % newfriendname.lower()
+    status = api.GetUserTimeline(newfriendname, count=200,
+                                 since_id = cache.get_cursor(source))
+    status = cache.cursor_iterator(status, source, _id_key, _seen_key)
     for s in status:
-        text = s.text.encode('utf-8')
-        print 'Learning from %s: %r' % (newfriendname, text)
+        metrics.incr('learned.twitter_user')
         yield s.text.encode('utf-8')
 
 def _seen_key(i):
     return str('seen_%s' % i.id)
 
+def _id_key(i):
+    return long(i.id)
+
 if __name__=='__main__':
     main(*sys.argv[1:])